@@ -2,7 +2,6 @@ from dotenv import load_dotenv
 load_dotenv()  # Загружаем переменные окружения
 
 import os
-import sys
 import logging
 import asyncio
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -14,7 +13,13 @@ from telegram.ext import (
     filters,
     ContextTypes,
 )
-import db
+import tts_cache
+import tts_queue
+import broadcast
+import stats
+import metrics
+import resilience
+import lifecycle
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +43,9 @@ def build_admin_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("Broadcast Message", callback_data="admin:broadcast")],
         [InlineKeyboardButton("Maintenance Message", callback_data="admin:maintenance")],
         [InlineKeyboardButton("Get DB Stats", callback_data="admin:dbstats")],
+        [InlineKeyboardButton("TTS Cache Stats", callback_data="admin:cache")],
+        [InlineKeyboardButton("TTS Queue Stats", callback_data="admin:queue")],
+        [InlineKeyboardButton("Latency Metrics", callback_data="admin:metrics")],
         [InlineKeyboardButton("Restart Bot", callback_data="admin:restart")],
         [InlineKeyboardButton("Shutdown Bot", callback_data="admin:shutdown")]
     ]
@@ -71,22 +79,30 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
         await query.edit_message_text("Введите сообщение о ремонте для рассылки всем пользователям:\n(Введите текст или нажмите /cancel для отмены)")
         return MAINTENANCE
     elif data == "admin:dbstats":
-        cursor = db.conn.cursor()
-        cursor.execute("SELECT * FROM users")
-        users_data = cursor.fetchall()
-        cursor.execute("SELECT * FROM requests ORDER BY timestamp DESC LIMIT 50")
-        requests_data = cursor.fetchall()
-        text = "DB Statistics:\n\nUsers:\n"
-        for row in users_data:
-            text += f"{row}\n"
-        text += "\nLast 50 Requests:\n"
-        for row in requests_data:
-            text += f"{row}\n"
+        with metrics.timer("admin_stats"):
+            text = await asyncio.to_thread(stats.build_report)
         await query.edit_message_text(text=text, reply_markup=build_admin_keyboard())
         return ConversationHandler.END
+    elif data == "admin:cache":
+        await query.edit_message_text(text=tts_cache.cache.stats_text(), reply_markup=build_admin_keyboard())
+        return ConversationHandler.END
+    elif data == "admin:queue":
+        await query.edit_message_text(text=tts_queue.queue.stats_text(), reply_markup=build_admin_keyboard())
+        return ConversationHandler.END
+    elif data == "admin:metrics":
+        text = metrics.summary_text() + "\n\n" + resilience.stats_text()
+        await query.edit_message_text(text=text[:4096], reply_markup=build_admin_keyboard())
+        return ConversationHandler.END
+    elif data.startswith("admin:bcancel:"):
+        job_id = int(data.split(":", 2)[2])
+        if await broadcast.cancel_broadcast(job_id):
+            await query.edit_message_text(f"Рассылка #{job_id} отменяется...")
+        else:
+            await query.edit_message_text(f"Рассылка #{job_id} уже завершена.")
+        return ConversationHandler.END
     elif data == "admin:restart":
         await query.edit_message_text("Перезапуск бота...")
-        asyncio.create_task(restart_bot())
+        asyncio.create_task(restart_bot(context))
         return ConversationHandler.END
     elif data == "admin:shutdown":
         await query.edit_message_text("Выключение бота...")
@@ -104,18 +120,9 @@ async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Access denied.")
         return ConversationHandler.END
 
-    cursor = db.conn.cursor()
-    cursor.execute("SELECT user_id FROM users")
-    user_ids = [row[0] for row in cursor.fetchall()]
-    success = 0
-    for uid in user_ids:
-        try:
-            await context.bot.send_message(chat_id=uid, text=message_text)
-            success += 1
-        except Exception as e:
-            logger.error(f"Ошибка отправки сообщения пользователю {uid}: {e}")
-            continue
-    await update.message.reply_text(f"Сообщение отправлено {success} пользователям.", reply_markup=build_admin_keyboard())
+    # Рассылка идёт в фоне с учётом лимитов Telegram; прогресс обновляется в отдельном сообщении
+    await broadcast.start_broadcast(context.bot, message_text, update.effective_chat.id)
+    await update.message.reply_text("Рассылка запущена.", reply_markup=build_admin_keyboard())
     return ConversationHandler.END
 
 async def maintenance_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -126,18 +133,8 @@ async def maintenance_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("Access denied.")
         return ConversationHandler.END
 
-    cursor = db.conn.cursor()
-    cursor.execute("SELECT user_id FROM users")
-    user_ids = [row[0] for row in cursor.fetchall()]
-    success = 0
-    for uid in user_ids:
-        try:
-            await context.bot.send_message(chat_id=uid, text="Бот на ремонте. " + message_text)
-            success += 1
-        except Exception as e:
-            logger.error(f"Ошибка отправки maintenance-сообщения пользователю {uid}: {e}")
-            continue
-    await update.message.reply_text(f"Maintenance сообщение отправлено {success} пользователям.", reply_markup=build_admin_keyboard())
+    await broadcast.start_broadcast(context.bot, "Бот на ремонте. " + message_text, update.effective_chat.id)
+    await update.message.reply_text("Maintenance рассылка запущена.", reply_markup=build_admin_keyboard())
     return ConversationHandler.END
 
 async def cancel_admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -145,11 +142,11 @@ async def cancel_admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE
     await update.message.reply_text("Действие отменено.", reply_markup=build_admin_keyboard())
     return ConversationHandler.END
 
-async def restart_bot():
-    """Перезапускает бота, заменяя текущий процесс."""
+async def restart_bot(context: ContextTypes.DEFAULT_TYPE):
+    """Перезапускает бота, заменяя текущий процесс, после корректной остановки."""
     logger.info("Перезапуск бота...")
-    python = sys.executable
-    os.execv(python, [python] + sys.argv)
+    # execv не вызывает atexit-обработчики: дожидаемся задач, сохраняем данные и снимок состояния вручную
+    await lifecycle.restart(context.application)
 
 async def shutdown_bot(context: ContextTypes.DEFAULT_TYPE):
     """Выключает бота."""
@@ -158,7 +155,7 @@ async def shutdown_bot(context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=ADMIN_IDS[0], text="Бот выключается по запросу админа.")
     except Exception as e:
         logger.error(f"Ошибка отправки сообщения администратору: {e}")
-    os._exit(0)
+    await lifecycle.shutdown(context.application)
 
 def register_admin_handlers(application):
     """Регистрирует админ-обработчики в приложении."""
@@ -0,0 +1,38 @@
+from dotenv import load_dotenv
+load_dotenv()  # Загружаем переменные окружения
+
+import os
+import logging
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Таймауты и размер пула соединений к OpenAI-прокси (секунды / штуки)
+CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT", "120"))
+POOL_TIMEOUT = float(os.getenv("OPENAI_POOL_TIMEOUT", "30"))
+POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "20"))
+KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_KEEPALIVE_CONNECTIONS", str(POOL_SIZE)))
+
+# Общий клиент с keep-alive пулом; создаётся при первом обращении
+_client = None
+
+def get_client() -> httpx.AsyncClient:
+    """Возвращает общий асинхронный HTTP-клиент, создавая его при необходимости."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT, pool=POOL_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=POOL_SIZE,
+                max_keepalive_connections=KEEPALIVE_CONNECTIONS,
+            ),
+        )
+    return _client
+
+async def close_client():
+    """Закрывает общий клиент и все соединения пула."""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
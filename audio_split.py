@@ -0,0 +1,89 @@
+from dotenv import load_dotenv
+load_dotenv()  # Загружаем переменные окружения
+
+import os
+import re
+import shutil
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+FFMPEG = os.getenv("FFMPEG_PATH") or shutil.which("ffmpeg")
+# Желаемая и максимальная длина сегмента (сек), параметры детектора тишины
+SEGMENT_TARGET_SECONDS = float(os.getenv("VOICE_SEGMENT_TARGET_SECONDS", "60"))
+SEGMENT_MAX_SECONDS = float(os.getenv("VOICE_SEGMENT_MAX_SECONDS", "90"))
+SILENCE_NOISE = os.getenv("VOICE_SILENCE_NOISE", "-35dB")
+SILENCE_MIN_SECONDS = float(os.getenv("VOICE_SILENCE_MIN_SECONDS", "0.4"))
+
+_SILENCE_START_RE = re.compile(r"silence_start: (-?[\d.]+)")
+_SILENCE_END_RE = re.compile(r"silence_end: (-?[\d.]+)")
+
+def available() -> bool:
+    """Разбиение возможно только при установленном ffmpeg."""
+    return bool(FFMPEG)
+
+async def _ffmpeg(args: list, data: bytes):
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG, "-hide_banner", "-loglevel", "info", *args,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate(data)
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg завершился с кодом {process.returncode}: {stderr[-500:]!r}")
+    return stdout, stderr.decode("utf-8", "replace")
+
+async def find_silences(data: bytes) -> list:
+    """Возвращает список интервалов тишины (start, end) в секундах."""
+    _, log = await _ffmpeg(
+        ["-i", "pipe:0", "-af", f"silencedetect=noise={SILENCE_NOISE}:d={SILENCE_MIN_SECONDS}", "-f", "null", "-"],
+        data,
+    )
+    starts = [float(x) for x in _SILENCE_START_RE.findall(log)]
+    ends = [float(x) for x in _SILENCE_END_RE.findall(log)]
+    return list(zip(starts, ends))
+
+def choose_cut_points(silences: list, duration: float, target: float = SEGMENT_TARGET_SECONDS,
+                      max_len: float = SEGMENT_MAX_SECONDS) -> list:
+    """
+    Выбирает точки разреза: середину паузы, ближайшую к position + target,
+    но не раньше position + target / 2 и не позже position + max_len.
+    Если подходящей паузы нет, режет ровно через max_len.
+    """
+    cuts = []
+    position = 0.0
+    middles = [(start + end) / 2 for start, end in silences]
+    while duration - position > max_len:
+        wanted = position + target
+        candidates = [m for m in middles if position + target / 2 <= m <= position + max_len]
+        cut = min(candidates, key=lambda m: abs(m - wanted)) if candidates else position + max_len
+        cuts.append(cut)
+        position = cut
+    return cuts
+
+async def cut_segment(data: bytes, start: float, end: float = None) -> bytes:
+    """Вырезает сегмент [start, end) без перекодирования."""
+    args = ["-i", "pipe:0", "-ss", f"{start:.3f}"]
+    if end is not None:
+        args += ["-to", f"{end:.3f}"]
+    args += ["-c", "copy", "-f", "ogg", "pipe:1"]
+    segment, _ = await _ffmpeg(args, data)
+    return segment
+
+async def split_on_silence(data: bytes, duration: float) -> list:
+    """
+    Делит запись на сегменты по паузам. Возвращает список OGG-сегментов по порядку
+    (один элемент, если делить не нужно).
+    """
+    if duration <= SEGMENT_MAX_SECONDS:
+        return [data]
+    cuts = choose_cut_points(await find_silences(data), duration)
+    if not cuts:
+        return [data]
+    bounds = [0.0] + cuts
+    return list(await asyncio.gather(*(
+        cut_segment(data, start, bounds[i + 1] if i + 1 < len(bounds) else None)
+        for i, start in enumerate(bounds)
+    )))
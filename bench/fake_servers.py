@@ -0,0 +1,213 @@
+"""
+Локальные заглушки для нагрузочного тестирования:
+OpenAI-совместимый API (/v1/audio/speech, /v1/audio/transcriptions) с настраиваемой задержкой
+и размером ответа, и Bot API, который принимает исходящие сообщения бота и запоминает их время,
+а через getUpdates отдаёт апдейты, переданные ему в POST /__updates (для прогона в режиме шардов).
+
+Запуск отдельно:
+    python bench/fake_servers.py --bot-port 8081 --api-port 8082 --tts-latency 0.5
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import multiprocessing
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeConfig:
+    def __init__(self, tts_latency=0.3, tts_jitter=0.1, payload_size=64 * 1024,
+                 stt_latency=0.5, error_rate=0.0, telegram_latency=0.02, doc_chars=2000):
+        self.tts_latency = tts_latency
+        self.tts_jitter = tts_jitter
+        self.payload_size = payload_size
+        self.stt_latency = stt_latency
+        self.error_rate = error_rate
+        self.telegram_latency = telegram_latency
+        self.doc_chars = doc_chars
+
+def _sleep(base, jitter=0.0):
+    if base > 0:
+        time.sleep(max(0.0, base + random.uniform(-jitter, jitter)))
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _reply(self, status: int, body: bytes, content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# --- OpenAI ---
+
+class FakeOpenAIHandler(_Handler):
+    def do_POST(self):
+        body = self._body()
+        cfg = self.config
+        if random.random() < cfg.error_rate:
+            self._reply(500, b'{"error": "fake upstream failure"}')
+            return
+        if self.path.endswith("/audio/speech"):
+            _sleep(cfg.tts_latency, cfg.tts_jitter)
+            payload = json.loads(body or b"{}")
+            content_type = "audio/ogg" if payload.get("response_format") == "opus" else "audio/mpeg"
+            self._reply(200, os.urandom(cfg.payload_size), content_type)
+        elif self.path.endswith("/audio/transcriptions"):
+            _sleep(cfg.stt_latency, cfg.tts_jitter)
+            self._reply(200, json.dumps({"text": "transcript of %d bytes" % len(body)}).encode())
+        else:
+            self._reply(404, b'{"error": "not found"}')
+
+# --- Bot API ---
+
+_FIELD_RE = re.compile(rb'name="([^"]+)"\r\n(?:[^\r\n]+\r\n)*\r\n(.*?)\r\n--', re.S)
+
+def _parse_fields(content_type: str, body: bytes) -> dict:
+    if content_type.startswith("multipart/form-data"):
+        return {
+            name.decode(): value.decode("utf-8", "replace")
+            for name, value in _FIELD_RE.findall(body)
+            if len(value) < 4096
+        }
+    if content_type.startswith("application/json"):
+        return {k: str(v) for k, v in json.loads(body or b"{}").items()}
+    return {k: v[0] for k, v in parse_qs(body.decode("utf-8", "replace")).items()}
+
+class FakeBotAPIHandler(_Handler):
+    events = None
+    events_lock = None
+    counter = None
+    updates = None  # апдейты для getUpdates, по возрастанию update_id
+    updates_cond = None
+
+    def _message(self, chat_id, **extra):
+        with self.events_lock:
+            self.counter[0] += 1
+            message_id = self.counter[0]
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private"},
+        }
+        message.update(extra)
+        return message
+
+    def do_GET(self):
+        if self.path.startswith("/__events"):
+            with self.events_lock:
+                data = json.dumps(list(self.events)).encode()
+                if "clear=1" in self.path:
+                    self.events[:] = []
+            self._reply(200, data)
+            return
+        # Скачивание файла: /file/bot<token>/<file_path>
+        if "/documents/" in self.path:
+            text = ("Это тестовое предложение для синтеза речи. " * 100)[: self.config.doc_chars]
+            self._reply(200, text.encode("utf-8"), "text/plain")
+        else:
+            self._reply(200, os.urandom(32 * 1024), "audio/ogg")
+
+    def _get_updates(self, fields: dict) -> list:
+        """Long polling: отдаёт апдейты с update_id >= offset, ожидая их не дольше timeout."""
+        offset = int(fields.get("offset") or 0)
+        limit = int(fields.get("limit") or 100)
+        deadline = time.monotonic() + float(fields.get("timeout") or 0)
+        with self.updates_cond:
+            # Апдейты до offset подтверждены клиентом
+            while self.updates and self.updates[0]["update_id"] < offset:
+                self.updates.pop(0)
+            while not self.updates and time.monotonic() < deadline:
+                self.updates_cond.wait(deadline - time.monotonic())
+            return self.updates[:limit]
+
+    def do_POST(self):
+        if self.path.startswith("/__updates"):
+            with self.updates_cond:
+                self.updates.extend(json.loads(self._body() or b"[]"))
+                self.updates_cond.notify_all()
+            self._reply(200, b'{"ok": true}')
+            return
+        method = self.path.rsplit("/", 1)[-1]
+        fields = _parse_fields(self.headers.get("Content-Type", ""), self._body())
+        chat_id = fields.get("chat_id")
+        _sleep(self.config.telegram_latency)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            result = self._get_updates(fields)
+        elif method == "getFile":
+            file_id = fields.get("file_id", "")
+            folder = "documents" if file_id.startswith("doc") else "voice"
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_path": f"{folder}/{file_id}"}
+        elif method == "sendMessage":
+            result = self._message(chat_id, text=fields.get("text", ""))
+        elif method == "sendAudio":
+            result = self._message(chat_id, audio={"file_id": "a%d" % time.time_ns(), "file_unique_id": "a", "duration": 1})
+        elif method == "sendVoice":
+            result = self._message(chat_id, voice={"file_id": "v%d" % time.time_ns(), "file_unique_id": "v", "duration": 1})
+        elif method == "editMessageText":
+            result = self._message(chat_id, text=fields.get("text", ""))
+        else:
+            result = True
+        with self.events_lock:
+            self.events.append([time.time(), method, chat_id, fields.get("text", "")[:40]])
+        self._reply(200, json.dumps({"ok": True, "result": result}).encode())
+
+def serve(bot_port: int, api_port: int, config: FakeConfig, ready=None):
+    """Запускает обе заглушки в текущем процессе (блокирующе)."""
+    FakeOpenAIHandler.config = config
+    FakeBotAPIHandler.config = config
+    FakeBotAPIHandler.events = []
+    FakeBotAPIHandler.events_lock = threading.Lock()
+    FakeBotAPIHandler.counter = [0]
+    FakeBotAPIHandler.updates = []
+    FakeBotAPIHandler.updates_cond = threading.Condition()
+    api = ThreadingHTTPServer(("127.0.0.1", api_port), FakeOpenAIHandler)
+    bot = ThreadingHTTPServer(("127.0.0.1", bot_port), FakeBotAPIHandler)
+    api.daemon_threads = bot.daemon_threads = True
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    if ready is not None:
+        ready.set()
+    bot.serve_forever()
+
+def start_in_process(bot_port: int, api_port: int, config: FakeConfig) -> multiprocessing.Process:
+    """Запускает заглушки в отдельном процессе, чтобы они не делили GIL с ботом."""
+    ctx = multiprocessing.get_context("spawn")
+    ready = ctx.Event()
+    process = ctx.Process(target=serve, args=(bot_port, api_port, config, ready), daemon=True)
+    process.start()
+    ready.wait(10)
+    time.sleep(0.2)
+    return process
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Заглушки Bot API и OpenAI-прокси")
+    parser.add_argument("--bot-port", type=int, default=8081)
+    parser.add_argument("--api-port", type=int, default=8082)
+    parser.add_argument("--tts-latency", type=float, default=0.3)
+    parser.add_argument("--stt-latency", type=float, default=0.5)
+    parser.add_argument("--payload-size", type=int, default=64 * 1024)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args(argv)
+    config = FakeConfig(
+        tts_latency=args.tts_latency, stt_latency=args.stt_latency,
+        payload_size=args.payload_size, error_rate=args.error_rate,
+    )
+    print(f"Bot API: http://127.0.0.1:{args.bot_port}, OpenAI: http://127.0.0.1:{args.api_port}/v1", file=sys.stderr)
+    serve(args.bot_port, args.api_port, config)
+
+if __name__ == "__main__":
+    main()
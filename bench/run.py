@@ -0,0 +1,479 @@
+"""
+Нагрузочный прогон: синтетические апдейты проходят через настоящие обработчики бота
+(handle_text, handle_document, handle_voice, рассылка из админки), а Telegram и OpenAI
+заменены локальными заглушками из fake_servers.py.
+
+Пример:
+    python bench/run.py --updates 500 --users 50 --rate 100 --tts-latency 0.3 --broadcast \
+        --output bench-results/run.json --compare bench-results/baseline.json
+
+С --shards N бот запускается отдельным процессом в режиме шардов (SHARD_WORKERS=N), и апдейты
+проходят весь путь: getUpdates заглушки -> распределитель -> воркер; так проверяется,
+как пропускная способность растёт с числом ядер:
+    python bench/run.py --updates 2000 --rate 0 --shards 4
+
+Результат (JSON): updates/sec, задержка ответа p50/p95/p99, задержка event loop,
+скорость записи в БД и длительность рассылки.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import signal
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, ROOT)
+
+import fake_servers
+
+ADMIN_ID = 1
+FIRST_USER_ID = 1000
+# Сообщения бота, которыми завершается обработка апдейта
+FINAL_PREFIXES = ("transcript", "Ошибка", "Нет текста", "У вас слишком много", "Сервис озвучки")
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _free_port_range(count: int) -> int:
+    """Первый из count подряд идущих свободных портов (метрики шарда i – на base + i)."""
+    for _ in range(50):
+        base = _free_port()
+        try:
+            for port in range(base, base + count):
+                with socket.socket() as s:
+                    s.bind(("127.0.0.1", port))
+        except OSError:
+            continue
+        return base
+    raise RuntimeError("Не удалось найти свободные порты для метрик шардов")
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=5
+        ).stdout.strip()
+    except Exception:
+        return ""
+
+# --- Синтетические апдейты ---
+
+class Traffic:
+    def __init__(self, args):
+        self.args = args
+        self.update_id = 0
+        self.texts = []
+        self.voices = []
+        self.rng = random.Random(args.seed)
+
+    def _message(self, user_id: int, **fields) -> dict:
+        self.update_id += 1
+        message = {
+            "message_id": self.update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        }
+        message.update(fields)
+        return {"update_id": self.update_id, "message": message}
+
+    def text(self, user_id: int) -> dict:
+        if self.texts and self.rng.random() < self.args.repeat:
+            text = self.rng.choice(self.texts)
+        else:
+            text = f"Синтетический запрос номер {self.update_id}. " * self.rng.randint(1, 8)
+            self.texts.append(text)
+        return self._message(user_id, text=text)
+
+    def document(self, user_id: int) -> dict:
+        file_id = f"doc-{self.update_id}"
+        return self._message(user_id, document={
+            "file_id": file_id, "file_unique_id": file_id, "file_name": "text.txt", "mime_type": "text/plain",
+        })
+
+    def voice(self, user_id: int) -> dict:
+        if self.voices and self.rng.random() < self.args.repeat:
+            file_id = self.rng.choice(self.voices)
+        else:
+            file_id = f"voice-{self.update_id}"
+            self.voices.append(file_id)
+        return self._message(user_id, voice={"file_id": file_id, "file_unique_id": file_id, "duration": 5})
+
+    def callback(self, user_id: int, data: str) -> dict:
+        self.update_id += 1
+        return {"update_id": self.update_id, "callback_query": {
+            "id": str(self.update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": self.update_id, "date": int(time.time()), "text": "Admin Panel:",
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+            },
+        }}
+
+    def admin_text(self, text: str) -> dict:
+        message = self._message(ADMIN_ID, text=text)
+        return message
+
+    def next(self) -> tuple:
+        """Следующий апдейт (kind, user_id, data) согласно --mix."""
+        kind = self.rng.choices(("text", "document", "voice"), weights=self.args.mix)[0]
+        user_id = FIRST_USER_ID + self.rng.randrange(self.args.users)
+        return kind, user_id, getattr(self, kind)(user_id)
+
+# --- Измерения ---
+
+class LoopLagMonitor:
+    """Задержка event loop: насколько позже запланированного просыпается sleep."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+async def fetch_events(client, clear: bool = False) -> list:
+    response = await client.get("/__events" + ("?clear=1" if clear else ""))
+    return response.json()
+
+def match_latencies(submitted: dict, events: list) -> tuple:
+    """
+    Сопоставляет отправленные апдейты с итоговыми ответами бота. Запросы одного пользователя
+    выполняются очередью по порядку, поэтому ответы в чат сопоставляются по FIFO.
+    Возвращает (задержки, время последнего ответа).
+    """
+    finals = {}
+    for ts, method, chat_id, text in events:
+        if chat_id is None:
+            continue
+        if method in ("sendAudio", "sendVoice") or (method == "sendMessage" and text.startswith(FINAL_PREFIXES)):
+            finals.setdefault(int(chat_id), []).append(ts)
+    latencies = []
+    last = 0.0
+    for chat_id, times in submitted.items():
+        for sent_at, done_at in zip(times, sorted(finals.get(chat_id, []))):
+            latencies.append(done_at - sent_at)
+            last = max(last, done_at)
+    return latencies, last
+
+# --- Прогон ---
+
+class InProcessBot:
+    """Бот в процессе бенчмарка: апдейты кладутся прямо в update_queue, метрики читаются из модуля."""
+
+    def __init__(self, application):
+        self.application = application
+
+    async def submit(self, data: dict):
+        await self.application.update_queue.put(_to_update(data, self.application))
+
+    async def counter(self, name: str, **labels) -> float:
+        import metrics
+        return metrics.get_counter(name, **labels)
+
+    async def flush(self):
+        import db
+        await asyncio.to_thread(db.flush)
+
+class ShardedBot:
+    """
+    Бот отдельным процессом в режиме шардов: апдейты отдаются ему через getUpdates заглушки,
+    метрики собираются с /metrics каждого воркера и суммируются.
+    """
+
+    def __init__(self, client, metrics_ports: list):
+        self.client = client
+        self.metrics_ports = metrics_ports
+
+    async def submit(self, data: dict):
+        await self.client.post("/__updates", json=[data])
+
+    async def counter(self, name: str, **labels) -> float:
+        import httpx
+        wanted = [f'{k}="{v}"' for k, v in labels.items()]
+        total = 0.0
+        async with httpx.AsyncClient(timeout=10) as client:
+            for port in self.metrics_ports:
+                text = (await client.get(f"http://127.0.0.1:{port}/metrics")).text
+                for line in text.splitlines():
+                    series, _, value = line.rpartition(" ")
+                    if series.split("{", 1)[0] == name and all(label in series for label in wanted):
+                        total += float(value)
+        return total
+
+    async def flush(self):
+        # Писатель БД в воркерах сбрасывает очередь не реже раза в DB_WRITE_FLUSH_INTERVAL
+        await asyncio.sleep(2)
+
+async def run_load(args, bot, traffic, client) -> dict:
+    if args.format == "voice":
+        # Переключаем всех пользователей на голосовые через обычные кнопки настроек
+        for user_id in range(FIRST_USER_ID, FIRST_USER_ID + args.users):
+            await bot.submit(traffic.callback(user_id, "format:voice"))
+        await asyncio.sleep(1)
+        await fetch_events(client, clear=True)
+    submitted = {}
+    kinds = {"text": 0, "document": 0, "voice": 0}
+    rows_before = await bot.counter("bot_db_rows_written_total")
+    started = time.time()
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+    for i in range(args.updates):
+        kind, user_id, data = traffic.next()
+        kinds[kind] += 1
+        submitted.setdefault(user_id, []).append(time.time())
+        await bot.submit(data)
+        if interval:
+            # Держим заданный темп относительно старта, а не относительно предыдущего апдейта
+            delay = started + (i + 1) * interval - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    deadline = time.time() + args.timeout
+    while True:
+        events = await fetch_events(client)
+        latencies, last = match_latencies(submitted, events)
+        if len(latencies) >= args.updates or time.time() > deadline:
+            break
+        await asyncio.sleep(0.5)
+    await bot.flush()
+    elapsed = max(1e-9, (last or time.time()) - started)
+    rows = await bot.counter("bot_db_rows_written_total") - rows_before
+    return {
+        "submitted": args.updates,
+        "completed": len(latencies),
+        "by_kind": kinds,
+        "uploads": {
+            method: sum(1 for event in events if event[1] == method) for method in ("sendAudio", "sendVoice")
+        },
+        "duration_s": round(elapsed, 3),
+        "updates_per_s": round(len(latencies) / elapsed, 2),
+        "latency_s": {
+            "p50": round(percentile(latencies, 0.50), 4),
+            "p95": round(percentile(latencies, 0.95), 4),
+            "p99": round(percentile(latencies, 0.99), 4),
+            "max": round(max(latencies, default=0.0), 4),
+        },
+        "tts_coalesced": int(await bot.counter("bot_singleflight_coalesced_total", flight="tts")),
+        "db_rows_written": int(rows),
+        "db_rows_per_s": round(rows / elapsed, 1),
+    }
+
+async def run_broadcast(args, application, traffic) -> dict:
+    import db
+    import broadcast
+
+    await asyncio.to_thread(db.flush)
+    started = time.time()
+    await application.update_queue.put(_to_update(traffic.callback(ADMIN_ID, "admin:broadcast"), application))
+    await asyncio.sleep(0.5)
+    await application.update_queue.put(_to_update(traffic.admin_text("Бенчмарк рассылки"), application))
+    deadline = time.time() + args.timeout
+    while not broadcast._jobs and time.time() < deadline:
+        await asyncio.sleep(0.05)
+    jobs = list(broadcast._jobs.values())
+    for job in jobs:
+        await asyncio.wait_for(job.task, max(1.0, deadline - time.time()))
+    elapsed = time.time() - started
+    sent = sum(job.sent for job in jobs)
+    return {
+        "recipients": sum(job.total for job in jobs),
+        "sent": sent,
+        "failed": sum(job.failed for job in jobs),
+        "duration_s": round(elapsed, 3),
+        "messages_per_s": round(sent / elapsed, 2) if elapsed else 0.0,
+    }
+
+def _to_update(data: dict, application):
+    from telegram import Update
+    return Update.de_json(data, application.bot)
+
+async def bench(args, bot_port: int, api_port: int) -> dict:
+    import httpx
+    import telegram_bot
+
+    telegram_bot.openai.api_base = f"http://127.0.0.1:{api_port}/v1"
+    application = telegram_bot.build_application(updater=False)
+    await application.initialize()
+    await application.start()
+    traffic = Traffic(args)
+    lag = LoopLagMonitor()
+    lag.start()
+    result = {}
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{bot_port}", timeout=30) as client:
+            await fetch_events(client, clear=True)
+            result["load"] = await run_load(args, InProcessBot(application), traffic, client)
+            if args.broadcast:
+                result["broadcast"] = await run_broadcast(args, application, traffic)
+    finally:
+        lag.stop()
+        await application.stop()
+        await application.shutdown()
+        await telegram_bot.on_shutdown(application)
+    result["event_loop_lag_s"] = {
+        "p50": round(percentile(lag.samples, 0.50), 4),
+        "p99": round(percentile(lag.samples, 0.99), 4),
+        "max": round(max(lag.samples, default=0.0), 4),
+    }
+    return result
+
+async def bench_sharded(args, bot_port: int, api_port: int, workdir: str) -> dict:
+    """Прогон с ботом в режиме шардов: отдельный процесс telegram_bot.py с SHARD_WORKERS воркерами."""
+    import httpx
+
+    metrics_base = _free_port_range(args.shards)
+    env = dict(os.environ, SHARD_WORKERS=str(args.shards), METRICS_PORT=str(metrics_base),
+               OPENAI_API_BASE=f"http://127.0.0.1:{api_port}/v1", SHARD_POLL_TIMEOUT="1")
+    log_path = os.path.join(workdir, "bot.log")
+    with open(log_path, "wb") as log:
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "telegram_bot.py")], cwd=workdir, env=env, stdout=log, stderr=log,
+        )
+    ports = [metrics_base + i for i in range(args.shards)]
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{bot_port}", timeout=30) as client:
+            bot = ShardedBot(client, ports)
+            # Воркеры готовы, когда отвечают их эндпоинты метрик
+            deadline = time.time() + 60
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError(f"Бот завершился при запуске, см. {log_path}")
+                try:
+                    await bot.counter("bot_db_rows_written_total")
+                    break
+                except httpx.HTTPError:
+                    if time.time() > deadline:
+                        raise
+                    await asyncio.sleep(0.5)
+            await fetch_events(client, clear=True)
+            return {"load": await run_load(args, bot, Traffic(args), client)}
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(120)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+# --- Сравнение ---
+
+def _flatten(data: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def compare(result: dict, baseline: dict) -> str:
+    """Таблица изменений числовых метрик относительно прошлого прогона."""
+    current = _flatten(result["results"])
+    previous = _flatten(baseline["results"])
+    lines = [f"{'metric':<32}{'baseline':>12}{'current':>12}{'change':>10}"]
+    for key in sorted(current.keys() & previous.keys()):
+        before, after = previous[key], current[key]
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "-"
+        lines.append(f"{key:<32}{before:>12}{after:>12}{change:>10}")
+    return "\n".join(lines)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота на локальных заглушках")
+    parser.add_argument("--updates", type=int, default=200, help="число апдейтов")
+    parser.add_argument("--users", type=int, default=50, help="число пользователей")
+    parser.add_argument("--mix", type=float, nargs=3, default=[0.7, 0.15, 0.15], metavar=("TEXT", "DOC", "VOICE"),
+                        help="доли текста, документов и голосовых")
+    parser.add_argument("--rate", type=float, default=50, help="апдейтов в секунду (0 – все сразу)")
+    parser.add_argument("--repeat", type=float, default=0.2, help="доля повторяющихся запросов (попадания в кэш)")
+    parser.add_argument("--tts-latency", type=float, default=0.3)
+    parser.add_argument("--stt-latency", type=float, default=0.5)
+    parser.add_argument("--payload-size", type=int, default=64 * 1024, help="размер ответа /audio/speech, байт")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500 от API")
+    parser.add_argument("--doc-chars", type=int, default=2000, help="длина текста в документах")
+    parser.add_argument("--format", choices=("audio", "voice"), default="audio",
+                        help="формат ответа: MP3-аудио или голосовое Opus")
+    parser.add_argument("--broadcast", action="store_true", help="после нагрузки запустить рассылку из админки")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="запустить бота отдельным процессом с N воркерами (SHARD_WORKERS)")
+    parser.add_argument("--timeout", type=float, default=300, help="сколько ждать ответов, сек")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="куда сохранить JSON с результатами")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args(argv)
+    if args.shards and args.broadcast:
+        parser.error("--broadcast пока поддерживается только без --shards")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING)
+    bot_port, api_port = _free_port(), _free_port()
+    servers = fake_servers.start_in_process(bot_port, api_port, fake_servers.FakeConfig(
+        tts_latency=args.tts_latency, stt_latency=args.stt_latency, payload_size=args.payload_size,
+        error_rate=args.error_rate, doc_chars=args.doc_chars,
+    ))
+    workdir = tempfile.mkdtemp(prefix="tts-bench-")
+    # Модули бота читают настройки при импорте, поэтому окружение задаётся до него
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "123456:bench",
+        "OPENAI_API_KEY": "bench",
+        "TELEGRAM_API_BASE": f"http://127.0.0.1:{bot_port}",
+        "DB_PATH": os.path.join(workdir, "activity.db"),
+        "TTS_CACHE_DIR": os.path.join(workdir, "tts_cache"),
+        "ADMIN_IDS": str(ADMIN_ID),
+        "METRICS_PORT": "0",
+        "SHARD_WORKERS": "0",
+    })
+    try:
+        if args.shards:
+            results = asyncio.run(bench_sharded(args, bot_port, api_port, workdir))
+        else:
+            results = asyncio.run(bench(args, bot_port, api_port))
+    finally:
+        servers.terminate()
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": _git_revision(),
+        "params": vars(args),
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print(compare(report, json.load(f)), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+from dotenv import load_dotenv
+load_dotenv()  # Загружаем переменные окружения
+
+import os
+import time
+import asyncio
+import logging
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, Forbidden, BadRequest, TelegramError
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Telegram допускает около 30 сообщений в секунду на бота; берём с запасом
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+# Прогресс редактируется не чаще, чем раз в N секунд (лимит на сообщения в один чат)
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+
+class RateLimiter:
+    """
+    Ограничитель частоты отправки (token bucket) с глобальной паузой,
+    которая включается, когда Telegram отвечает RetryAfter.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+class BroadcastJob:
+    """Состояние одной выполняющейся рассылки."""
+
+    def __init__(self, job_id: int, text: str, admin_chat_id: int, message_id, counts: dict):
+        self.job_id = job_id
+        self.text = text
+        self.admin_chat_id = admin_chat_id
+        self.message_id = message_id
+        self.sent = counts.get("sent", 0)
+        self.failed = counts.get("failed", 0)
+        self.total = sum(counts.values())
+        self.cancelled = asyncio.Event()
+        self.paused = False  # остановлена перед перезапуском: в БД остаётся running и возобновится
+        self.task = None
+
+# job_id -> BroadcastJob для рассылок, выполняющихся в этом процессе
+_jobs = {}
+_limiter = None
+
+def _get_limiter() -> RateLimiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter(BROADCAST_RATE)
+    return _limiter
+
+def _progress_text(job: BroadcastJob, final_status: str = None) -> str:
+    done = job.sent + job.failed
+    header = {
+        None: "Рассылка #%s выполняется" % job.job_id,
+        "done": "Рассылка #%s завершена" % job.job_id,
+        "cancelled": "Рассылка #%s отменена" % job.job_id,
+    }[final_status]
+    return f"{header}\n\nОтправлено: {job.sent}\nОшибок: {job.failed}\nОбработано: {done} из {job.total}"
+
+def _cancel_keyboard(job_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Отменить рассылку", callback_data=f"admin:bcancel:{job_id}")]])
+
+async def _edit_progress(bot, job: BroadcastJob, final_status: str = None):
+    if job.message_id is None:
+        return
+    try:
+        await bot.edit_message_text(
+            chat_id=job.admin_chat_id,
+            message_id=job.message_id,
+            text=_progress_text(job, final_status),
+            reply_markup=None if final_status else _cancel_keyboard(job.job_id),
+        )
+    except BadRequest as e:
+        # "Message is not modified" и т.п. – не критично
+        logger.debug("Не удалось обновить прогресс рассылки %s: %s", job.job_id, e)
+    except TelegramError as e:
+        logger.warning("Не удалось обновить прогресс рассылки %s: %s", job.job_id, e)
+
+async def _send_one(bot, job: BroadcastJob, user_id: int):
+    limiter = _get_limiter()
+    attempt = 0
+    while not job.cancelled.is_set():
+        await limiter.acquire()
+        try:
+            with metrics.timer("broadcast_send"):
+                await bot.send_message(chat_id=user_id, text=job.text)
+        except RetryAfter as e:
+            logger.warning("Flood control при рассылке %s: пауза %s с", job.job_id, e.retry_after)
+            limiter.pause(float(e.retry_after))
+            continue
+        except (Forbidden, BadRequest) as e:
+            # Пользователь заблокировал бота или чат не существует – повтор бессмыслен
+            db.mark_broadcast_recipient(job.job_id, user_id, "failed", str(e))
+            job.failed += 1
+            return
+        except TelegramError as e:
+            attempt += 1
+            if attempt < BROADCAST_MAX_RETRIES:
+                await asyncio.sleep(attempt)
+                continue
+            logger.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
+            db.mark_broadcast_recipient(job.job_id, user_id, "failed", str(e))
+            job.failed += 1
+            return
+        db.mark_broadcast_recipient(job.job_id, user_id, "sent")
+        job.sent += 1
+        return
+
+async def _run(bot, job: BroadcastJob):
+    pending = asyncio.Queue()
+    for user_id in db.get_pending_broadcast_recipients(job.job_id):
+        pending.put_nowait(user_id)
+
+    async def worker():
+        while not job.cancelled.is_set():
+            try:
+                user_id = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await _send_one(bot, job, user_id)
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            # Отмену могли записать в БД из другого процесса (режим шардов)
+            row = await asyncio.to_thread(db.get_broadcast_job, job.job_id)
+            if row is not None and row[4] == "cancelled":
+                job.cancelled.set()
+                return
+            await _edit_progress(bot, job)
+
+    reporter_task = asyncio.create_task(reporter())
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, BROADCAST_CONCURRENCY))))
+    finally:
+        reporter_task.cancel()
+        _jobs.pop(job.job_id, None)
+    if job.paused:
+        logger.info("Рассылка %s приостановлена: отправлено %s, ошибок %s", job.job_id, job.sent, job.failed)
+        return
+    status = "cancelled" if job.cancelled.is_set() else "done"
+    await asyncio.to_thread(db.set_broadcast_status, job.job_id, status)
+    await _edit_progress(bot, job, status)
+    logger.info("Рассылка %s: %s, отправлено %s, ошибок %s", job.job_id, status, job.sent, job.failed)
+
+def _launch(bot, job_id: int) -> BroadcastJob:
+    _, text, admin_chat_id, message_id, _ = db.get_broadcast_job(job_id)
+    job = BroadcastJob(job_id, text, admin_chat_id, message_id, db.get_broadcast_counts(job_id))
+    _jobs[job_id] = job
+    job.task = asyncio.create_task(_run(bot, job))
+    return job
+
+async def start_broadcast(bot, text: str, admin_chat_id: int) -> int:
+    """
+    Создаёт задание рассылки, отправляет админу сообщение с прогрессом и кнопкой отмены
+    и запускает отправку в фоне. Возвращает id задания.
+    """
+    job_id = await asyncio.to_thread(db.create_broadcast_job, text, admin_chat_id)
+    message = await bot.send_message(
+        chat_id=admin_chat_id,
+        text=f"Рассылка #{job_id} запускается...",
+        reply_markup=_cancel_keyboard(job_id),
+    )
+    await asyncio.to_thread(db.set_broadcast_progress_message, job_id, message.message_id)
+    _launch(bot, job_id)
+    return job_id
+
+async def cancel_broadcast(job_id: int) -> bool:
+    """
+    Отменяет выполняющуюся рассылку. Возвращает False, если такой рассылки нет.
+    Рассылку из другого процесса отменяет статус в БД: её воркер проверяет его при обновлении прогресса.
+    """
+    job = _jobs.get(job_id)
+    if job is None:
+        if job_id in await asyncio.to_thread(db.get_running_broadcast_jobs):
+            await asyncio.to_thread(db.set_broadcast_status, job_id, "cancelled")
+            return True
+        return False
+    job.cancelled.set()
+    return True
+
+async def pause_all(timeout: float):
+    """
+    Останавливает рассылки этого процесса перед перезапуском, не отмечая их отменёнными:
+    начатые отправки дописываются, и после старта resume_broadcasts продолжит с оставшихся получателей.
+    """
+    jobs = list(_jobs.values())
+    for job in jobs:
+        job.paused = True
+        job.cancelled.set()
+    tasks = [job.task for job in jobs if job.task is not None]
+    if not tasks:
+        return
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+
+async def resume_broadcasts(bot):
+    """Возобновляет рассылки, прерванные перезапуском бота (вызывается при старте)."""
+    for job_id in db.get_running_broadcast_jobs():
+        if job_id not in _jobs:
+            logger.info("Возобновляем рассылку %s", job_id)
+            _launch(bot, job_id)
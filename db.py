@@ -1,12 +1,62 @@
+from dotenv import load_dotenv
+load_dotenv()  # Загружаем переменные окружения
+
+import os
+import time
+import queue
+import asyncio
+import atexit
+import logging
 import sqlite3
+import threading
 from datetime import datetime
+from collections import OrderedDict
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv("DB_PATH", "activity.db")
+# Параметры фоновой записи: размер очереди, максимальная пачка и интервал сброса (сек)
+WRITE_QUEUE_SIZE = int(os.getenv("DB_WRITE_QUEUE_SIZE", "10000"))
+WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "500"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("DB_WRITE_FLUSH_INTERVAL", "1.0"))
+# Сколько раз повторять пачку при временной ошибке (БД заблокирована), прежде чем писать по одному
+WRITE_RETRIES = int(os.getenv("DB_WRITE_RETRIES", "3"))
+WRITES_DROPPED = "bot_db_writes_dropped_total"
+
+# Сколько профилей пользователей держим в памяти для пропуска неизменных обновлений
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
 
-# Подключаемся к базе данных activity.db.
+def _connect():
+    connection = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+# Соединение с activity.db открывается лениво, при первом обращении (см. get_conn).
+# Оно используется для чтения; все записи на горячем пути идут через фоновый поток-писатель.
 # Используем check_same_thread=False, чтобы один объект соединения мог использоваться в разных потоках.
-conn = sqlite3.connect("activity.db", check_same_thread=False)
-cursor = conn.cursor()
+conn = None
+_init_lock = threading.Lock()
+
+def get_conn():
+    """Возвращает соединение для чтения, при первом вызове открывая БД и создавая схему."""
+    if conn is None:
+        init_db()
+    return conn
 
 def init_db():
+    """Открывает БД и создаёт/мигрирует схему (один раз за процесс)."""
+    global conn
+    with _init_lock:
+        if conn is not None:
+            return
+        connection = _connect()
+        _create_schema(connection)
+        conn = connection
+
+def _create_schema(connection):
+    cursor = connection.cursor()
     # Создаём таблицу users, если её ещё нет.
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS users (
@@ -15,7 +65,7 @@ def init_db():
         first_name TEXT,
         last_name TEXT,
         total_requests INTEGER DEFAULT 0,
-        monthly_requests INTEGER DEFAULT 0
+        monthly_requests INTEGER DEFAULT 0  -- устарело, помесячные счётчики хранятся в monthly_usage
     )
     """)
     # Создаём таблицу requests для логирования каждого запроса, с дополнительными данными о настройках.
@@ -30,92 +80,468 @@ def init_db():
         FOREIGN KEY (user_id) REFERENCES users(user_id)
     )
     """)
-    # Создаем таблицу metadata для хранения служебной информации (например, последний сброс месяца)
+    # Индексы для выборок по времени и по пользователю
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_requests_timestamp ON requests(timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_requests_user_id ON requests(user_id)")
+    # Почасовая сводка запросов, поддерживается инкрементально при каждом log_request.
+    # hour = 'YYYY-MM-DD HH:00' (UTC), пустая строка вместо NULL в model_used/voice_used.
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS requests_hourly (
+        hour TEXT,
+        user_id INTEGER,
+        request_type TEXT,
+        model_used TEXT,
+        voice_used TEXT,
+        requests INTEGER DEFAULT 0,
+        PRIMARY KEY (hour, user_id, request_type, model_used, voice_used)
+    )
+    """)
+    cursor.execute("SELECT 1 FROM requests_hourly LIMIT 1")
+    if cursor.fetchone() is None:
+        # Первичное заполнение сводки из уже накопленных запросов
+        cursor.execute("""
+            INSERT INTO requests_hourly (hour, user_id, request_type, model_used, voice_used, requests)
+            SELECT strftime('%Y-%m-%d %H:00', timestamp), user_id, COALESCE(request_type, ''),
+                   COALESCE(model_used, ''), COALESCE(voice_used, ''), COUNT(*)
+            FROM requests
+            GROUP BY 1, 2, 3, 4, 5
+        """)
+    # Дневная сводка: сюда retention сворачивает старые строки requests_hourly (day = 'YYYY-MM-DD', UTC)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS requests_daily (
+        day TEXT,
+        user_id INTEGER,
+        request_type TEXT,
+        model_used TEXT,
+        voice_used TEXT,
+        requests INTEGER DEFAULT 0,
+        PRIMARY KEY (day, user_id, request_type, model_used, voice_used)
+    )
+    """)
+    # Создаем таблицу metadata для хранения служебной информации
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS metadata (
         key TEXT PRIMARY KEY,
         value TEXT
     )
     """)
-    # Инициализируем метаданные, если нет записи для last_reset_month
+    # Помесячные счётчики запросов: одна строка на пользователя и месяц (year_month = 'YYYY-MM')
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS monthly_usage (
+        user_id INTEGER,
+        year_month TEXT,
+        requests INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, year_month)
+    )
+    """)
+    # Задания рассылки и состояние доставки по каждому получателю (для возобновления после перезапуска)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT,
+        admin_chat_id INTEGER,
+        progress_message_id INTEGER,
+        status TEXT DEFAULT 'running',
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        job_id INTEGER,
+        user_id INTEGER,
+        status TEXT DEFAULT 'pending',
+        error TEXT,
+        PRIMARY KEY (job_id, user_id)
+    )
+    """)
+    # Сохранённые настройки пользователей (context.user_data) в JSON
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS user_data (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    # Кэш транскрипций голосовых сообщений по Telegram file_unique_id
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS transcripts (
+        file_unique_id TEXT PRIMARY KEY,
+        text TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    # Переносим счётчики текущего месяца из старой схемы со сбросом users.monthly_requests
     cursor.execute("SELECT value FROM metadata WHERE key = 'last_reset_month'")
     row = cursor.fetchone()
-    if row is None:
-        current_month = datetime.now().month
-        cursor.execute("INSERT INTO metadata (key, value) VALUES (?, ?)", ("last_reset_month", str(current_month)))
-    conn.commit()
+    if row is not None:
+        if int(row[0]) == datetime.now().month:
+            cursor.execute("""
+                INSERT OR IGNORE INTO monthly_usage (user_id, year_month, requests)
+                SELECT user_id, ?, monthly_requests FROM users WHERE monthly_requests > 0
+            """, (current_year_month(),))
+        cursor.execute("DELETE FROM metadata WHERE key = 'last_reset_month'")
+    connection.commit()
 
-def get_user(user_id):
-    cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-    return cursor.fetchone()
+# Кэш текущего месяца: строка 'YYYY-MM' и момент, до которого она актуальна
+_year_month = None
+_year_month_until = None
 
-def add_or_update_user(user_id, username, first_name, last_name):
+def current_year_month():
+    """Возвращает текущий месяц в виде 'YYYY-MM', пересчитывая его только при смене месяца."""
+    global _year_month, _year_month_until
+    now = datetime.now()
+    if _year_month_until is None or now >= _year_month_until:
+        _year_month = now.strftime("%Y-%m")
+        if now.month == 12:
+            _year_month_until = datetime(now.year + 1, 1, 1)
+        else:
+            _year_month_until = datetime(now.year, now.month + 1, 1)
+    return _year_month
+
+# --- Фоновая запись ---
+
+_write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+_writer_thread = None
+_writer_lock = threading.Lock()
+_STOP = object()
+
+def _ensure_writer():
+    global _writer_thread
+    if _writer_thread is not None and _writer_thread.is_alive():
+        return
+    with _writer_lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _writer_thread = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+            _writer_thread.start()
+
+def enqueue_write(sql, params=()):
     """
-    Если пользователя с таким user_id нет, добавляет запись.
-    Иначе обновляет данные (username, first_name, last_name).
+    Ставит запись в очередь фонового писателя.
+    Писатель объединяет события в пачки и выполняет их в одной транзакции в порядке постановки;
+    подряд идущие одинаковые запросы выполняются одним executemany.
+    Если очередь переполнена, вызывающий из фонового потока ждёт освобождения места (backpressure),
+    а на event loop запись отбрасывается и учитывается в bot_db_writes_dropped_total: ждать писателя,
+    который повторяет пачку при блокировке БД, значит остановить весь бот.
     """
-    user = get_user(user_id)
-    if user is None:
-        cursor.execute("""
-            INSERT INTO users (user_id, username, first_name, last_name, total_requests, monthly_requests)
-            VALUES (?, ?, ?, ?, 0, 0)
-        """, (user_id, username, first_name, last_name))
-    else:
-        cursor.execute("""
-            UPDATE users
-            SET username = ?, first_name = ?, last_name = ?
-            WHERE user_id = ?
-        """, (username, first_name, last_name, user_id))
-    conn.commit()
+    _ensure_writer()
+    try:
+        _write_queue.put_nowait((sql, params))
+    except queue.Full:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            logger.warning("Очередь записи в БД переполнена, ожидаем писателя")
+            _write_queue.put((sql, params))
+            return
+        metrics.inc(WRITES_DROPPED)
+        dropped = metrics.get_counter(WRITES_DROPPED)
+        if dropped == 1 or dropped % 1000 == 0:
+            logger.error("Очередь записи в БД переполнена, отброшено записей: %d", dropped)
+
+def _runs(batch):
+    """Разбивает пачку на подряд идущие группы с одинаковым SQL, сохраняя порядок."""
+    runs = []
+    for sql, params in batch:
+        if runs and runs[-1][0] == sql:
+            runs[-1][1].append(params)
+        else:
+            runs.append((sql, [params]))
+    return runs
+
+def _apply_batch(wconn, batch):
+    with metrics.timer("db_commit"):
+        with wconn:
+            for sql, params_list in _runs(batch):
+                wconn.executemany(sql, params_list)
+    metrics.inc("bot_db_rows_written_total", len(batch))
+
+def _apply_one_by_one(wconn, batch):
+    """Запасной путь после ошибки пачки: каждое событие в своей транзакции, теряются только сбойные."""
+    failed = 0
+    for sql, params in batch:
+        try:
+            with wconn:
+                wconn.execute(sql, params)
+        except Exception as e:
+            failed += 1
+            logger.error("Ошибка записи в БД: %s; SQL: %s; параметры: %r", e, " ".join(sql.split()), params)
+    metrics.inc("bot_db_rows_written_total", len(batch) - failed)
+    if failed:
+        metrics.inc("bot_db_rows_failed_total", failed)
+
+def _write(wconn, batch):
+    for attempt in range(WRITE_RETRIES):
+        try:
+            _apply_batch(wconn, batch)
+            return
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) and "busy" not in str(e):
+                logger.error("Ошибка записи пачки из %s событий в БД: %s", len(batch), e)
+                break
+            # Блокировка БД другим процессом (шарды, обслуживание) – временная, пачку повторяем целиком
+            logger.warning("Ошибка записи пачки из %s событий в БД (попытка %s): %s", len(batch), attempt + 1, e)
+            time.sleep(0.5 * (attempt + 1))
+        except Exception as e:
+            logger.error("Ошибка записи пачки из %s событий в БД: %s", len(batch), e)
+            break
+    _apply_one_by_one(wconn, batch)
+
+def _writer_loop():
+    init_db()
+    wconn = _connect()
+    stopping = False
+    while not stopping:
+        item = _write_queue.get()
+        batch = []
+        waiters = []
+        deadline = None
+        while True:
+            if item is _STOP:
+                stopping = True
+            elif isinstance(item, threading.Event):
+                waiters.append(item)
+            else:
+                batch.append(item)
+                if deadline is None:
+                    # Пачка коммитится не позже WRITE_FLUSH_INTERVAL после первого события, даже при непрерывном потоке
+                    deadline = time.monotonic() + WRITE_FLUSH_INTERVAL
+            # flush() ждёт коммита – не копим дальше
+            if stopping or waiters or len(batch) >= WRITE_BATCH_SIZE:
+                break
+            timeout = max(0.0, deadline - time.monotonic()) if batch else 0.05
+            if batch and timeout == 0:
+                break
+            try:
+                item = _write_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+        # Досливаем всё, что уже лежит в очереди к моменту остановки
+        if stopping:
+            while True:
+                try:
+                    item = _write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                elif item is not _STOP:
+                    batch.append(item)
+        if batch:
+            _write(wconn, batch)
+        for waiter in waiters:
+            waiter.set()
+    wconn.close()
+
+def flush(timeout=None):
+    """Блокирует до тех пор, пока все ранее поставленные записи не будут закоммичены."""
+    if _writer_thread is None or not _writer_thread.is_alive():
+        return True
+    done = threading.Event()
+    _write_queue.put(done)
+    return done.wait(timeout)
+
+def close(timeout=30):
+    """Сбрасывает очередь записи и останавливает поток-писатель (вызывается при завершении)."""
+    global _writer_thread
+    if _writer_thread is None or not _writer_thread.is_alive():
+        return
+    _write_queue.put(_STOP)
+    _writer_thread.join(timeout)
+    _writer_thread = None
+
+atexit.register(close)
+
+# --- Пользователи и запросы ---
+
+# user_id -> (username, first_name, last_name), от давно не писавших к недавним
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
+
+def get_user(user_id):
+    return get_conn().execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
 
-def check_and_reset_monthly_requests():
+def add_or_update_user(user_id, username, first_name, last_name):
     """
-    Проверяет, если текущий месяц отличается от сохранённого в metadata, сбрасывает monthly_requests для всех пользователей.
+    Добавляет пользователя или обновляет его данные (username, first_name, last_name).
+    Если профиль не изменился с прошлого сообщения (по кэшу в памяти), БД не трогается;
+    иначе в очередь писателя ставится один INSERT ... ON CONFLICT DO UPDATE.
     """
-    current_month = datetime.now().month
-    cursor.execute("SELECT value FROM metadata WHERE key = 'last_reset_month'")
-    row = cursor.fetchone()
-    if row:
-        last_reset = int(row[0])
-        if current_month != last_reset:
-            # Сбрасываем monthly_requests для всех пользователей
-            cursor.execute("UPDATE users SET monthly_requests = 0")
-            # Обновляем метаданные
-            cursor.execute("UPDATE metadata SET value = ? WHERE key = 'last_reset_month'", (str(current_month),))
-            conn.commit()
+    profile = (username, first_name, last_name)
+    with _user_cache_lock:
+        if _user_cache.get(user_id) == profile:
+            _user_cache.move_to_end(user_id)
+            return
+        _user_cache[user_id] = profile
+        _user_cache.move_to_end(user_id)
+        while len(_user_cache) > USER_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+    enqueue_write("""
+        INSERT INTO users (user_id, username, first_name, last_name)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE
+        SET username = excluded.username,
+            first_name = excluded.first_name,
+            last_name = excluded.last_name
+    """, (user_id, username, first_name, last_name))
+
+def export_user_cache():
+    """Профили из кэша в памяти (от давних к недавним) – для передачи новому процессу при перезапуске."""
+    with _user_cache_lock:
+        return [[user_id, *profile] for user_id, profile in _user_cache.items()]
+
+def restore_user_cache(items):
+    """Восстанавливает кэш профилей, сохранённый export_user_cache."""
+    with _user_cache_lock:
+        for user_id, username, first_name, last_name in items[-USER_CACHE_SIZE:]:
+            _user_cache[user_id] = (username, first_name, last_name)
 
 def log_request(user_id, request_type, model_used=None, voice_used=None):
     """
-    Добавляет запись в таблицу requests и увеличивает счетчики в таблице users.
-    Также проверяет и сбрасывает ежемесячную статистику, если наступил новый месяц.
+    Ставит в очередь запись в таблицу requests, увеличение счетчиков пользователя
+    (общего в users и помесячного в monthly_usage) и почасовой сводки requests_hourly.
+    Время запроса фиксируется в момент вызова, запись выполняет фоновый писатель пачками.
     """
-    check_and_reset_monthly_requests()
-    cursor.execute("""
-        INSERT INTO requests (user_id, request_type, model_used, voice_used)
-        VALUES (?, ?, ?, ?)
-    """, (user_id, request_type, model_used, voice_used))
-    cursor.execute("""
-        UPDATE users
-        SET total_requests = total_requests + 1,
-            monthly_requests = monthly_requests + 1
-        WHERE user_id = ?
+    timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    enqueue_write("""
+        INSERT INTO requests (user_id, request_type, model_used, voice_used, timestamp)
+        VALUES (?, ?, ?, ?, ?)
+    """, (user_id, request_type, model_used, voice_used, timestamp))
+    # Счётчики тоже обновляются через upsert, чтобы не зависеть от порядка с записью профиля в пачке
+    enqueue_write("""
+        INSERT INTO users (user_id, total_requests)
+        VALUES (?, 1)
+        ON CONFLICT(user_id) DO UPDATE
+        SET total_requests = total_requests + 1
     """, (user_id,))
-    conn.commit()
+    enqueue_write("""
+        INSERT INTO monthly_usage (user_id, year_month, requests)
+        VALUES (?, ?, 1)
+        ON CONFLICT(user_id, year_month) DO UPDATE
+        SET requests = requests + 1
+    """, (user_id, current_year_month()))
+    enqueue_write("""
+        INSERT INTO requests_hourly (hour, user_id, request_type, model_used, voice_used, requests)
+        VALUES (?, ?, ?, ?, ?, 1)
+        ON CONFLICT(hour, user_id, request_type, model_used, voice_used) DO UPDATE
+        SET requests = requests + 1
+    """, (timestamp[:13] + ":00", user_id, request_type or "", model_used or "", voice_used or ""))
+
+def get_monthly_requests(user_id, year_month=None):
+    """
+    Возвращает число запросов пользователя за месяц year_month ('YYYY-MM', по умолчанию текущий).
+    """
+    row = get_conn().execute(
+        "SELECT requests FROM monthly_usage WHERE user_id = ? AND year_month = ?",
+        (user_id, year_month or current_year_month()),
+    ).fetchone()
+    return row[0] if row else 0
+
+def get_monthly_history(user_id):
+    """
+    Возвращает список (year_month, requests) пользователя по всем месяцам, от новых к старым.
+    """
+    return get_conn().execute(
+        "SELECT year_month, requests FROM monthly_usage WHERE user_id = ? ORDER BY year_month DESC",
+        (user_id,),
+    ).fetchall()
 
 def get_user_stats(user_id):
     """
     Возвращает (total_requests, monthly_requests) для данного пользователя.
     """
-    cursor.execute("SELECT total_requests, monthly_requests FROM users WHERE user_id = ?", (user_id,))
-    return cursor.fetchone()
-
-# Функция, которую можно запускать по расписанию (например, раз в месяц через cron)
-def reset_monthly_requests():
-    cursor.execute("UPDATE users SET monthly_requests = 0")
-    # Обновляем метаданные с текущим месяцем
-    current_month = datetime.now().month
-    cursor.execute("UPDATE metadata SET value = ? WHERE key = 'last_reset_month'", (str(current_month),))
-    conn.commit()
-
-# Инициализируем базу при импорте модуля.
-init_db()
+    row = get_conn().execute("SELECT total_requests FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    if row is None:
+        return None
+    return row[0], get_monthly_requests(user_id)
+
+# --- Настройки пользователей (PTB persistence) ---
+
+def get_user_data(user_id):
+    """Возвращает сохранённый JSON user_data пользователя или None."""
+    row = get_conn().execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+def save_user_data(user_id, data):
+    enqueue_write("""
+        INSERT INTO user_data (user_id, data, updated_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(user_id) DO UPDATE
+        SET data = excluded.data, updated_at = excluded.updated_at
+    """, (user_id, data))
+
+def delete_user_data(user_id):
+    enqueue_write("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+
+# --- Транскрипции ---
+
+def get_transcript(file_unique_id):
+    """Возвращает сохранённую транскрипцию голосового сообщения или None."""
+    row = get_conn().execute("SELECT text FROM transcripts WHERE file_unique_id = ?", (file_unique_id,)).fetchone()
+    return row[0] if row else None
+
+def save_transcript(file_unique_id, text):
+    enqueue_write(
+        "INSERT OR REPLACE INTO transcripts (file_unique_id, text) VALUES (?, ?)",
+        (file_unique_id, text),
+    )
+
+# --- Рассылки ---
+
+def create_broadcast_job(text, admin_chat_id):
+    """
+    Создаёт задание рассылки и список получателей (все пользователи) в одной транзакции.
+    Возвращает id задания.
+    """
+    flush()
+    connection = get_conn()
+    with connection:
+        cursor = connection.execute(
+            "INSERT INTO broadcast_jobs (text, admin_chat_id) VALUES (?, ?)", (text, admin_chat_id)
+        )
+        job_id = cursor.lastrowid
+        connection.execute("""
+            INSERT INTO broadcast_recipients (job_id, user_id)
+            SELECT ?, user_id FROM users
+        """, (job_id,))
+    return job_id
+
+def set_broadcast_progress_message(job_id, message_id):
+    connection = get_conn()
+    with connection:
+        connection.execute("UPDATE broadcast_jobs SET progress_message_id = ? WHERE id = ?", (message_id, job_id))
+
+def set_broadcast_status(job_id, status):
+    flush()
+    connection = get_conn()
+    with connection:
+        connection.execute("UPDATE broadcast_jobs SET status = ? WHERE id = ?", (status, job_id))
+
+def get_broadcast_job(job_id):
+    """Возвращает (id, text, admin_chat_id, progress_message_id, status) или None."""
+    return get_conn().execute(
+        "SELECT id, text, admin_chat_id, progress_message_id, status FROM broadcast_jobs WHERE id = ?",
+        (job_id,),
+    ).fetchone()
+
+def get_running_broadcast_jobs():
+    """Возвращает id незавершённых рассылок (для возобновления при старте)."""
+    return [row[0] for row in get_conn().execute("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id")]
+
+def get_pending_broadcast_recipients(job_id):
+    return [
+        row[0] for row in get_conn().execute(
+            "SELECT user_id FROM broadcast_recipients WHERE job_id = ? AND status = 'pending'", (job_id,)
+        )
+    ]
+
+def get_broadcast_counts(job_id):
+    """Возвращает словарь status -> количество получателей."""
+    return dict(get_conn().execute(
+        "SELECT status, COUNT(*) FROM broadcast_recipients WHERE job_id = ? GROUP BY status", (job_id,)
+    ).fetchall())
+
+def mark_broadcast_recipient(job_id, user_id, status, error=None):
+    enqueue_write(
+        "UPDATE broadcast_recipients SET status = ?, error = ? WHERE job_id = ? AND user_id = ?",
+        (status, error, job_id, user_id),
+    )
@@ -0,0 +1,201 @@
+from dotenv import load_dotenv
+load_dotenv()  # Загружаем переменные окружения
+
+import os
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import deque
+from telegram.error import Forbidden, BadRequest
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Окно сводки: повторы одной ошибки приходят админам одним сообщением раз в ERROR_DIGEST_INTERVAL (сек)
+ERROR_DIGEST_INTERVAL = float(os.getenv("ERROR_DIGEST_INTERVAL", "300"))
+# Не больше N сообщений админам в минуту (каждому админу – отдельное сообщение)
+ERROR_ALERTS_PER_MINUTE = int(os.getenv("ERROR_ALERTS_PER_MINUTE", "10"))
+# Как часто фоновая задача отправляет накопленное (сек)
+ERROR_FLUSH_INTERVAL = float(os.getenv("ERROR_FLUSH_INTERVAL", "5"))
+
+ERRORS_TOTAL = "bot_errors_total"
+ALERTS_DROPPED = "bot_error_alerts_dropped_total"
+
+MAX_MESSAGE_LENGTH = 4096
+# Каталог бота: место ошибки ищется в нашем коде, а не в глубине httpx/telegram
+_PROJECT_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+class _Entry:
+    __slots__ = ("fingerprint", "count", "first_seen", "sample", "text", "alerted_to")
+
+    def __init__(self, fingerprint: str, sample: BaseException):
+        self.fingerprint = fingerprint
+        self.count = 0
+        self.first_seen = time.monotonic()
+        self.sample = sample  # первое исключение окна: traceback форматируется уже в фоне
+        self.text = None
+        self.alerted_to = set()  # админы, которым алерт уже отправлен
+
+_lock = threading.Lock()
+_window = {}  # fingerprint -> _Entry за текущее окно
+_window_started = time.monotonic()
+_previous = set()  # отпечатки прошлого окна: о них не шлём отдельный алерт, только сводку
+_sent = deque()  # время отправленных админам сообщений за последнюю минуту
+# Недоставленные сводки: admin_id -> [начало первого окна, {fingerprint: [count, sample]}]
+_digest_backlog = {}
+_task = None
+
+def fingerprint(error: BaseException) -> str:
+    """Отпечаток ошибки: тип и место (последний кадр в коде бота, иначе последний кадр вообще)."""
+    last = ours = None
+    tb = error.__traceback__
+    while tb is not None:
+        last = tb
+        if tb.tb_frame.f_code.co_filename.startswith(_PROJECT_DIR):
+            ours = tb
+        tb = tb.tb_next
+    location = "?"
+    if last is not None:
+        tb = ours or last
+        code = tb.tb_frame.f_code
+        location = f"{os.path.basename(code.co_filename)}:{tb.tb_lineno} in {code.co_name}"
+    return f"{type(error).__name__} @ {location}"
+
+def report(error: BaseException):
+    """
+    Регистрирует ошибку. Дёшево для горячего пути: traceback в лог пишется только для первой
+    ошибки с этим отпечатком за окно, повторы – только счётчик; отправка админам – в фоновой задаче.
+    """
+    key = fingerprint(error)
+    metrics.inc(ERRORS_TOTAL, type=type(error).__name__)
+    with _lock:
+        entry = _window.get(key)
+        if entry is None:
+            entry = _window[key] = _Entry(key, error)
+        entry.count += 1
+        count = entry.count
+    if count == 1:
+        # Traceback в лог – один раз за окно для каждого отпечатка
+        logger.error("%s: %s", key, error, exc_info=error)
+    else:
+        logger.debug("Повтор ошибки %s (%s раз): %s", key, count, error)
+
+def _budget_left() -> int:
+    now = time.monotonic()
+    while _sent and now - _sent[0] > 60:
+        _sent.popleft()
+    return ERROR_ALERTS_PER_MINUTE - len(_sent)
+
+def _take_budget() -> bool:
+    if _budget_left() <= 0:
+        return False
+    _sent.append(time.monotonic())
+    return True
+
+async def _send(bot, admin_ids, text: str) -> set:
+    """
+    Отправляет text админам в пределах лимита. Возвращает тех, с кем отправка завершена:
+    доставлено или доставить невозможно (бот заблокирован, чат не найден) – таким не повторяем.
+    """
+    done = set()
+    for admin_id in admin_ids:
+        if not _take_budget():
+            metrics.inc(ALERTS_DROPPED)
+            continue
+        try:
+            await bot.send_message(chat_id=admin_id, text=text)
+            done.add(admin_id)
+        except (Forbidden, BadRequest) as e:
+            logger.error("Администратор %s недоступен для сообщений об ошибках: %s", admin_id, e)
+            done.add(admin_id)
+        except Exception as e:
+            logger.error("Не удалось отправить сообщение об ошибке администратору %s: %s", admin_id, e)
+    return done
+
+def _format_alert(entry: _Entry) -> str:
+    tb_string = "".join(traceback.format_exception(None, entry.sample, entry.sample.__traceback__))
+    header = f"An exception occurred: {entry.fingerprint}\n"
+    # Хвост traceback информативнее начала
+    return header + tb_string[-(MAX_MESSAGE_LENGTH - len(header)):]
+
+def _format_digest(counts: dict, seconds: float) -> str:
+    minutes = max(1, round(seconds / 60))
+    lines = [f"Errors in the last {minutes} min:"]
+    for fingerprint, (count, sample) in sorted(counts.items(), key=lambda item: item[1][0], reverse=True):
+        lines.append(f"{fingerprint} occurred {count} times in {minutes} min: {sample}"[:300])
+    text = "\n".join(lines)
+    if len(text) > MAX_MESSAGE_LENGTH:
+        text = text[:MAX_MESSAGE_LENGTH - 1] + "…"
+    return text
+
+def _add_to_backlog(window: dict, admin_ids, started: float):
+    """Переносит закрытое окно в сводки админов; недоставленная сводка копится дальше, а не теряется."""
+    for admin_id in admin_ids:
+        entries = [
+            e for e in window.values()
+            # Ошибка, о которой админ уже получил алерт и которая не повторялась, в его сводке не нужна
+            if e.count > 1 or admin_id not in e.alerted_to
+        ]
+        if not entries:
+            continue
+        since, counts = _digest_backlog.setdefault(admin_id, [started, {}])
+        for e in entries:
+            count, _ = counts.get(e.fingerprint, (0, None))
+            counts[e.fingerprint] = [count + e.count, e.sample]
+
+async def flush(bot, admin_ids, now: float = None):
+    """
+    Отправляет админам traceback новых ошибок и, по окончании окна, сводку повторов.
+    Ошибки, на алерт о которых не хватило лимита, попадают в сводку; сводка, на которую
+    не хватило лимита, объединяется со следующей и отправляется при первой возможности.
+    """
+    global _window, _window_started, _previous
+    now = now or time.monotonic()
+    with _lock:
+        fresh = [e for e in _window.values() if e.fingerprint not in _previous]
+    for entry in fresh:
+        waiting = [admin_id for admin_id in admin_ids if admin_id not in entry.alerted_to]
+        if not waiting:
+            continue
+        if entry.text is None:
+            entry.text = await asyncio.to_thread(_format_alert, entry)
+        # Без лимита алерт ждёт следующего прохода, а если окно кончится раньше – уходит в сводку
+        if _budget_left() > 0:
+            entry.alerted_to |= await _send(bot, waiting, entry.text)
+    if now - _window_started >= ERROR_DIGEST_INTERVAL:
+        with _lock:
+            window, _window = _window, {}
+            started, _window_started = _window_started, now
+        _previous = set(window)
+        _add_to_backlog(window, admin_ids, started)
+    for admin_id, (since, counts) in list(_digest_backlog.items()):
+        if _budget_left() <= 0:
+            break
+        if await _send(bot, [admin_id], _format_digest(counts, now - since)):
+            del _digest_backlog[admin_id]
+
+async def _loop(bot, admin_ids):
+    while True:
+        await asyncio.sleep(ERROR_FLUSH_INTERVAL)
+        try:
+            await flush(bot, admin_ids)
+        except Exception as e:
+            logger.error("Ошибка отправки сводки ошибок: %s", e, exc_info=e)
+
+def start(bot, admin_ids):
+    """
+    Запускает фоновую отправку алертов и сводок админам (вызывается при старте бота и в каждом шарде).
+    Без админов задача всё равно нужна: она сменяет окна, и traceback повторяющихся ошибок снова попадает в лог.
+    """
+    global _task
+    if not admin_ids:
+        logger.warning("ADMIN_IDS не заданы, ошибки только логируются")
+    if _task is None or _task.done():
+        _task = asyncio.create_task(_loop(bot, list(admin_ids)))
+
+def stop():
+    """Останавливает фоновую отправку."""
+    if _task is not None:
+        _task.cancel()
@@ -0,0 +1,132 @@
+from dotenv import load_dotenv
+load_dotenv()  # Загружаем переменные окружения
+
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import logging
+from telegram import Update
+import db
+import api_client
+import broadcast
+import resilience
+import retention
+import error_digest
+import tts_queue
+
+logger = logging.getLogger(__name__)
+
+# Файл, через который остановленный процесс передаёт новому незавершённые задачи и «тёплое» состояние
+SNAPSHOT_PATH = os.getenv("STATE_SNAPSHOT_PATH", "state_snapshot.json")
+# Сколько ждать завершения выполняющихся задач при остановке (сек)
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "60"))
+# Задачи из более старого снимка не восстанавливаются: пользователи уже не ждут ответа
+SNAPSHOT_MAX_AGE = float(os.getenv("STATE_SNAPSHOT_MAX_AGE", "3600"))
+
+SNAPSHOT_VERSION = 1
+
+# В режиме шардов – pid процесса-распределителя: перезапуском и остановкой всех воркеров управляет он
+dispatcher_pid = None
+
+async def _stop_intake(application):
+    """Прекращает приём апдейтов и забирает те, что получены, но ещё не обработаны."""
+    if application.updater is not None and application.updater.running:
+        await application.updater.stop()
+    updates = []
+    while not application.update_queue.empty():
+        update = application.update_queue.get_nowait()
+        if isinstance(update, Update):
+            updates.append(update.to_dict())
+    return updates
+
+def _write_snapshot(snapshot: dict):
+    tmp_path = SNAPSHOT_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+    os.replace(tmp_path, SNAPSHOT_PATH)
+
+async def drain(application):
+    """
+    Корректная остановка: перестаёт принимать апдейты и запускать новые задачи, ждёт выполняющиеся
+    не дольше DRAIN_TIMEOUT, приостанавливает рассылки, сохраняет user_data и очередь записи в БД,
+    а незавершённые задачи и прогретое состояние записывает в SNAPSHOT_PATH для следующего процесса.
+    """
+    started = time.monotonic()
+    retention.stop()
+    error_digest.stop()
+    unprocessed = await _stop_intake(application)
+    tts_queue.queue.pause()
+    if not await tts_queue.queue.wait_idle(DRAIN_TIMEOUT):
+        # Такие задачи будут выполнены заново после перезапуска (возможен повторный ответ)
+        logger.warning("Не все задачи завершились за %s с, они будут перезапущены", DRAIN_TIMEOUT)
+    # Рассылки продолжатся после старта; их отметки о доставке должны попасть в БД до db.close
+    await broadcast.pause_all(DRAIN_TIMEOUT)
+    jobs = tts_queue.queue.pending_payloads() + unprocessed
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "created_at": time.time(),
+        "updates": jobs,
+        "latency": resilience.export_state(),
+        "user_profiles": db.export_user_cache(),
+    }
+    try:
+        await asyncio.to_thread(_write_snapshot, snapshot)
+    except OSError as e:
+        logger.error("Не удалось сохранить снимок состояния: %s", e)
+    await application.update_persistence()
+    await asyncio.to_thread(db.close)
+    await api_client.close_client()
+    logger.info(
+        "Остановка за %.1f с: сохранено задач %s", time.monotonic() - started, len(jobs)
+    )
+
+async def restart(application):
+    """Перезапускает бота, заменяя текущий процесс, после корректной остановки."""
+    if dispatcher_pid is not None:
+        # Распределитель остановит все воркеры (каждый выполнит drain) и перезапустится сам
+        os.kill(dispatcher_pid, signal.SIGUSR1)
+        return
+    await drain(application)
+    python = sys.executable
+    os.execv(python, [python] + sys.argv)
+
+async def shutdown(application):
+    """Выключает бота после корректной остановки."""
+    if dispatcher_pid is not None:
+        os.kill(dispatcher_pid, signal.SIGTERM)
+        return
+    await drain(application)
+    os._exit(0)
+
+def _read_snapshot():
+    try:
+        with open(SNAPSHOT_PATH, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logger.error("Повреждённый снимок состояния %s: %s", SNAPSHOT_PATH, e)
+        snapshot = None
+    # Снимок применяется один раз
+    os.remove(SNAPSHOT_PATH)
+    return snapshot
+
+async def restore(application):
+    """Восстанавливает состояние из снимка предыдущего процесса, если он есть (вызывается при старте)."""
+    snapshot = await asyncio.to_thread(_read_snapshot)
+    if not snapshot or snapshot.get("version") != SNAPSHOT_VERSION:
+        return
+    resilience.restore_state(snapshot.get("latency", {}))
+    db.restore_user_cache(snapshot.get("user_profiles", []))
+    updates = snapshot.get("updates", [])
+    age = time.time() - snapshot.get("created_at", 0)
+    if age > SNAPSHOT_MAX_AGE:
+        logger.warning("Снимок состояния устарел (%.0f с), задачи не восстанавливаются: %s", age, len(updates))
+        return
+    # Апдейты заново проходят через обычные обработчики и встают в очередь в прежнем порядке
+    for data in updates:
+        await application.update_queue.put(Update.de_json(data, application.bot))
+    logger.info("Восстановлено задач из снимка: %s", len(updates))
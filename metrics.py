@@ -0,0 +1,191 @@
+from dotenv import load_dotenv
+load_dotenv()  # Загружаем переменные окружения
+
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Порт HTTP-эндпоинта /metrics в формате Prometheus (0 – не запускать)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Границы корзин гистограмм задержек (секунды)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+STAGE_SECONDS = "bot_stage_duration_seconds"
+UPSTREAM_REQUESTS = "bot_upstream_requests_total"
+UPSTREAM_INFLIGHT = "bot_upstream_inflight"
+
+_lock = threading.Lock()
+_histograms = {}  # (name, labels) -> [counts по корзинам + Inf, сумма]
+_counters = {}  # (name, labels) -> значение
+_gauges = {}  # (name, labels) -> значение
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted((k, "" if v is None else str(v)) for k, v in labels.items()))
+
+def observe(name: str, value: float, **labels):
+    """Добавляет наблюдение в гистограмму name."""
+    key = _key(name, labels)
+    index = bisect.bisect_left(BUCKETS, value)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+        hist[0][index] += 1
+        hist[1] += value
+
+def inc(name: str, value: float = 1, **labels):
+    """Увеличивает счётчик name."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def gauge_add(name: str, delta: float, **labels):
+    """Изменяет значение gauge name на delta."""
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + delta
+
+def gauge_set(name: str, value: float, **labels):
+    """Устанавливает значение gauge name."""
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = value
+
+def get_counter(name: str, **labels) -> float:
+    """Текущее значение счётчика (0, если его ещё не было)."""
+    with _lock:
+        return _counters.get(_key(name, labels), 0)
+
+@contextmanager
+def timer(stage: str, **labels):
+    """Замеряет длительность блока и пишет её в гистограмму этапов с меткой stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(STAGE_SECONDS, time.perf_counter() - start, stage=stage, **labels)
+
+@contextmanager
+def upstream(endpoint: str, **labels):
+    """
+    Учитывает обращение к API: число одновременных запросов, задержку и исход
+    (HTTP-статус или тип ошибки) в счётчике запросов.
+    """
+    gauge_add(UPSTREAM_INFLIGHT, 1, endpoint=endpoint)
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except Exception as e:
+        response = getattr(e, "response", None)
+        status = str(response.status_code) if response is not None else type(e).__name__
+        raise
+    finally:
+        gauge_add(UPSTREAM_INFLIGHT, -1, endpoint=endpoint)
+        observe(STAGE_SECONDS, time.perf_counter() - start, stage=endpoint, **labels)
+        inc(UPSTREAM_REQUESTS, endpoint=endpoint, status=status)
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    lines = []
+    with _lock:
+        histograms = {k: ([*v[0]], v[1]) for k, v in _histograms.items()}
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+    typed = set()
+    for (name, labels), (counts, total) in sorted(histograms.items()):
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        cumulative = 0
+        for bound, count in zip(BUCKETS, counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        cumulative += counts[-1]
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    for kind, values in (("counter", counters), ("gauge", gauges)):
+        for (name, labels), value in sorted(values.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} {kind}")
+                typed.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+def _quantile(counts, q):
+    """Оценка квантиля по корзинам гистограммы (верхняя граница корзины)."""
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q * total
+    cumulative = 0
+    for bound, count in zip(BUCKETS + (float("inf"),), counts):
+        cumulative += count
+        if cumulative >= rank:
+            return bound
+    return float("inf")
+
+def summary_text() -> str:
+    """Краткая сводка для админ-панели: задержки по этапам, ошибки API и текущая нагрузка."""
+    with _lock:
+        histograms = {k: ([*v[0]], v[1]) for k, v in _histograms.items() if k[0] == STAGE_SECONDS}
+        counters = {k: v for k, v in _counters.items() if k[0] == UPSTREAM_REQUESTS}
+        gauges = {k: v for k, v in _gauges.items() if k[0] == UPSTREAM_INFLIGHT}
+    per_stage = {}
+    for (_, labels), (counts, total) in histograms.items():
+        stage = dict(labels)["stage"]
+        merged = per_stage.setdefault(stage, [[0] * len(counts), 0.0])
+        merged[0] = [a + b for a, b in zip(merged[0], counts)]
+        merged[1] += total
+    lines = ["Latency by stage (count, avg, ~p50, ~p95):"]
+    for stage, (counts, total) in sorted(per_stage.items()):
+        n = sum(counts)
+        lines.append(
+            f"{stage}: {n}, {total / n:.3f}s, ≤{_quantile(counts, 0.5)}s, ≤{_quantile(counts, 0.95)}s"
+        )
+    lines.append("")
+    lines.append("Upstream requests:")
+    for (_, labels), value in sorted(counters.items()):
+        labels = dict(labels)
+        lines.append(f"{labels['endpoint']} {labels['status']}: {int(value)}")
+    lines.append("")
+    lines.append("In flight:")
+    for (_, labels), value in sorted(gauges.items()):
+        lines.append(f"{dict(labels)['endpoint']}: {int(value)}")
+    return "\n".join(lines)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(port: int):
+    """Запускает эндпоинт /metrics в фоновом потоке."""
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info("Метрики доступны на порту %s (/metrics)", port)
+    return server
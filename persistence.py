@@ -0,0 +1,99 @@
+from dotenv import load_dotenv
+load_dotenv()  # Загружаем переменные окружения
+
+import os
+import json
+import asyncio
+import logging
+from telegram.ext import BasePersistence, PersistenceInput
+import db
+
+logger = logging.getLogger(__name__)
+
+# Как часто PTB сбрасывает изменённые user_data в хранилище (секунды)
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "30"))
+
+class SQLitePersistence(BasePersistence):
+    """
+    Хранит context.user_data (выбранные модель и голос) в таблице user_data, одна строка на пользователя.
+    Данные загружаются лениво при первом апдейте пользователя, а записываются только изменившиеся
+    записи – через фоновый писатель db, пачками раз в update_interval.
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._loaded = set()  # user_id, для которых данные уже подняты из БД
+        self._snapshots = {}  # user_id -> последний записанный JSON
+
+    async def get_user_data(self):
+        # Ничего не загружаем при старте: данные подтягиваются в refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._loaded:
+            return
+        self._loaded.add(user_id)
+        raw = db.get_user_data(user_id)
+        if raw is None:
+            return
+        self._snapshots[user_id] = raw
+        try:
+            stored = json.loads(raw)
+        except ValueError as e:
+            logger.error("Повреждённые user_data пользователя %s: %s", user_id, e)
+            return
+        for key, value in stored.items():
+            user_data.setdefault(key, value)
+
+    async def update_user_data(self, user_id, data):
+        raw = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+        if self._snapshots.get(user_id) == raw:
+            return
+        self._snapshots[user_id] = raw
+        db.save_user_data(user_id, raw)
+
+    async def drop_user_data(self, user_id):
+        self._loaded.discard(user_id)
+        self._snapshots.pop(user_id, None)
+        db.delete_user_data(user_id)
+
+    async def flush(self):
+        await asyncio.to_thread(db.flush)
+
+    # Данные чатов, бота, callback_data и диалоги не сохраняются
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,229 @@
+from dotenv import load_dotenv
+load_dotenv()  # Загружаем переменные окружения
+
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+import httpx
+import api_client
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Запасные адреса OpenAI-прокси через запятую (используются для хеджирования и при отказе основного)
+FALLBACK_BASES = [b.strip().rstrip("/") for b in os.getenv("OPENAI_FALLBACK_BASES", "").split(",") if b.strip()]
+# Адаптивный таймаут ожидания ответа: p99 * множитель, в пределах [MIN, MAX]
+TIMEOUT_MULTIPLIER = float(os.getenv("UPSTREAM_TIMEOUT_MULTIPLIER", "3"))
+MIN_TIMEOUT = float(os.getenv("UPSTREAM_MIN_TIMEOUT", "15"))
+MAX_TIMEOUT = float(os.getenv("UPSTREAM_MAX_TIMEOUT", str(api_client.READ_TIMEOUT)))
+# Сколько последних задержек хранить и сколько нужно, чтобы им доверять
+LATENCY_WINDOW = int(os.getenv("UPSTREAM_LATENCY_WINDOW", "200"))
+MIN_SAMPLES = int(os.getenv("UPSTREAM_MIN_SAMPLES", "20"))
+# Хеджирование: второй запрос, если первый дольше p95 (но не раньше HEDGE_MIN_DELAY)
+HEDGE_ENABLED = os.getenv("UPSTREAM_HEDGE", "1") == "1"
+HEDGE_MIN_DELAY = float(os.getenv("UPSTREAM_HEDGE_MIN_DELAY", "1"))
+# Повторы с экспоненциальной задержкой и полным джиттером
+RETRIES = int(os.getenv("UPSTREAM_RETRIES", "3"))
+BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5"))
+# Circuit breaker: после N отказов подряд адрес считается недоступным на COOLDOWN секунд
+BREAKER_THRESHOLD = int(os.getenv("UPSTREAM_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("UPSTREAM_BREAKER_COOLDOWN", "30"))
+
+RETRIABLE_STATUSES = {429, 500, 502, 503, 504}
+
+UNAVAILABLE_TEXT = "Сервис озвучки и распознавания временно недоступен. Попробуйте через минуту."
+
+HEDGES = "bot_upstream_hedges_total"
+RETRIES_TOTAL = "bot_upstream_retries_total"
+BREAKER_OPEN = "bot_upstream_breaker_open"
+
+class UpstreamUnavailable(Exception):
+    """API недоступен (circuit breaker разомкнут) – запрос не отправлялся."""
+
+    def __init__(self):
+        super().__init__(UNAVAILABLE_TEXT)
+
+class LatencyTracker:
+    """Скользящее окно задержек ответа одного эндпоинта."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float):
+        """Квантиль q или None, пока наблюдений меньше MIN_SAMPLES."""
+        if len(self._samples) < MIN_SAMPLES:
+            return None
+        values = sorted(self._samples)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def timeout(self) -> float:
+        p99 = self.percentile(0.99)
+        if p99 is None:
+            return MAX_TIMEOUT
+        return min(MAX_TIMEOUT, max(MIN_TIMEOUT, p99 * TIMEOUT_MULTIPLIER))
+
+    def hedge_delay(self):
+        p95 = self.percentile(0.95)
+        if p95 is None or not HEDGE_ENABLED:
+            return None
+        return max(HEDGE_MIN_DELAY, p95)
+
+class CircuitBreaker:
+    """
+    Размыкается после BREAKER_THRESHOLD отказов подряд; через BREAKER_COOLDOWN секунд
+    пропускает пробные запросы: успех замыкает его, отказ снова размыкает.
+    """
+
+    def __init__(self, base: str):
+        self.base = base
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self) -> bool:
+        return self.opened_at is None or time.monotonic() - self.opened_at >= BREAKER_COOLDOWN
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("API %s снова доступен", self.base)
+            metrics.gauge_add(BREAKER_OPEN, -1, base=self.base)
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None:
+            # Пробный запрос не прошёл – ждём ещё один период
+            self.opened_at = time.monotonic()
+        elif self.failures >= BREAKER_THRESHOLD:
+            logger.error("API %s недоступен (%s ошибок подряд), запросы приостановлены", self.base, self.failures)
+            self.opened_at = time.monotonic()
+            metrics.gauge_add(BREAKER_OPEN, 1, base=self.base)
+
+_trackers = {}  # endpoint -> LatencyTracker
+_breakers = {}  # base url -> CircuitBreaker
+
+def _tracker(endpoint: str) -> LatencyTracker:
+    tracker = _trackers.get(endpoint)
+    if tracker is None:
+        tracker = _trackers[endpoint] = LatencyTracker()
+    return tracker
+
+def _breaker(base: str) -> CircuitBreaker:
+    breaker = _breakers.get(base)
+    if breaker is None:
+        breaker = _breakers[base] = CircuitBreaker(base)
+    return breaker
+
+def is_retriable(e: Exception) -> bool:
+    """Можно ли повторить запрос после ошибки e: сетевой сбой, таймаут или 429/5xx."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in RETRIABLE_STATUSES
+    return isinstance(e, (httpx.TransportError, asyncio.TimeoutError))
+
+async def _send_once(endpoint: str, base: str, build_request, timeout: float) -> httpx.Response:
+    """Один запрос к base: ждёт заголовков ответа не дольше timeout, тело не читает."""
+    breaker = _breaker(base)
+    start = time.perf_counter()
+    try:
+        response = await asyncio.wait_for(
+            api_client.get_client().send(build_request(base), stream=True), timeout
+        )
+    except (httpx.TransportError, asyncio.TimeoutError):
+        breaker.record_failure()
+        raise
+    if response.is_error:
+        await response.aclose()
+        if response.status_code >= 500:
+            breaker.record_failure()
+        response.raise_for_status()
+    breaker.record_success()
+    _tracker(endpoint).add(time.perf_counter() - start)
+    return response
+
+async def _close_responses(tasks):
+    """Отменяет проигравшие попытки и закрывает ответы, которые всё же успели прийти."""
+    for task in tasks:
+        task.cancel()
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, httpx.Response):
+            await result.aclose()
+
+async def _hedged(endpoint: str, bases: list, build_request) -> httpx.Response:
+    """
+    Отправляет запрос к bases[0]; если ответа нет дольше p95, параллельно отправляет второй
+    (на запасной адрес, если он есть) и возвращает тот, что ответит первым.
+    """
+    tracker = _tracker(endpoint)
+    timeout = tracker.timeout()
+    tasks = [asyncio.create_task(_send_once(endpoint, bases[0], build_request, timeout))]
+    winner = None
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=tracker.hedge_delay())
+        if not done:
+            metrics.inc(HEDGES, endpoint=endpoint)
+            base = bases[1] if len(bases) > 1 else bases[0]
+            tasks.append(asyncio.create_task(_send_once(endpoint, base, build_request, timeout)))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    winner = task
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        await _close_responses([task for task in tasks if task is not winner])
+
+async def send(endpoint: str, primary_base: str, build_request) -> httpx.Response:
+    """
+    Отправляет запрос к API с адаптивным таймаутом, хеджированием, повторами и circuit breaker.
+    build_request(base_url) -> httpx.Request. Возвращает открытый потоковый ответ с успешным
+    статусом; вызывающий читает тело и закрывает его (response.aclose()).
+    Если все адреса недоступны, сразу бросает UpstreamUnavailable.
+    """
+    bases = [primary_base] + [b for b in FALLBACK_BASES if b != primary_base]
+    for attempt in range(RETRIES):
+        available = [b for b in bases if _breaker(b).allow()]
+        if not available:
+            raise UpstreamUnavailable()
+        try:
+            return await _hedged(endpoint, available, build_request)
+        except Exception as e:
+            if not is_retriable(e) or attempt + 1 >= RETRIES:
+                raise
+            logger.warning("Ошибка запроса к %s (попытка %s): %s", endpoint, attempt + 1, str(e) or type(e).__name__)
+        metrics.inc(RETRIES_TOTAL, endpoint=endpoint)
+        await asyncio.sleep(random.uniform(0, BACKOFF_BASE * 2 ** attempt))
+
+def export_state() -> dict:
+    """Накопленные задержки по эндпоинтам – чтобы после перезапуска таймауты и хеджирование не начинали с нуля."""
+    return {endpoint: list(tracker._samples) for endpoint, tracker in _trackers.items()}
+
+def restore_state(state: dict):
+    for endpoint, samples in state.items():
+        tracker = _tracker(endpoint)
+        for seconds in samples:
+            tracker.add(seconds)
+
+def stats_text() -> str:
+    """Текущие таймауты, задержка хеджирования и состояние адресов API (для админ-панели)."""
+    lines = ["Upstream resilience:"]
+    for endpoint, tracker in sorted(_trackers.items()):
+        p95 = tracker.percentile(0.95)
+        hedge = tracker.hedge_delay()
+        lines.append(
+            f"{endpoint}: p95 {'-' if p95 is None else f'{p95:.2f}s'}, "
+            f"timeout {tracker.timeout():.1f}s, hedge after {'-' if hedge is None else f'{hedge:.2f}s'}"
+        )
+    for base, breaker in sorted(_breakers.items()):
+        state = "open" if breaker.opened_at is not None else "closed"
+        lines.append(f"{base}: {state}, failures in a row {breaker.failures}")
+    return "\n".join(lines)
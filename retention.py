@@ -0,0 +1,156 @@
+from dotenv import load_dotenv
+load_dotenv()  # Загружаем переменные окружения
+
+import os
+import gzip
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timedelta
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Сырые запросы старше N дней выгружаются в архив и удаляются из requests (0 – не трогать)
+REQUESTS_RETENTION_DAYS = int(os.getenv("REQUESTS_RETENTION_DAYS", "90"))
+# Почасовая сводка старше N дней сворачивается в дневную (не меньше 31 – отчёты смотрят за 30 дней)
+HOURLY_RETENTION_DAYS = max(31, int(os.getenv("HOURLY_RETENTION_DAYS", "180")))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+# Размер пачки и пауза между пачками: каждая транзакция короткая, писатель бота не ждёт долго
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "1000"))
+RETENTION_BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", "0.05"))
+# Расписание: первый запуск через RETENTION_INITIAL_DELAY после старта, затем раз в RETENTION_INTERVAL
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", str(24 * 3600)))
+RETENTION_INITIAL_DELAY = float(os.getenv("RETENTION_INITIAL_DELAY", "300"))
+# В режиме dry-run только считается, что было бы сделано
+RETENTION_DRY_RUN = os.getenv("RETENTION_DRY_RUN", "0") == "1"
+
+ROWS_TOTAL = "bot_retention_rows_total"
+
+_conn = None
+_stop = threading.Event()
+_task = None
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        db.init_db()
+        _conn = sqlite3.connect(db.DB_PATH, check_same_thread=False, timeout=30)
+    return _conn
+
+def _append_archive(rows):
+    """
+    Дописывает строки в архивы requests-YYYY-MM.jsonl.gz (по месяцу запроса).
+    Каждый вызов добавляет новый gzip-member, поэтому файлы только растут и читаются целиком
+    обычным gzip. При сбое между архивацией и удалением строки могут повториться – id уникален.
+    """
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    by_month = {}
+    for row_id, user_id, request_type, model_used, voice_used, timestamp in rows:
+        line = json.dumps({
+            "id": row_id, "user_id": user_id, "request_type": request_type,
+            "model_used": model_used, "voice_used": voice_used, "timestamp": timestamp,
+        }, ensure_ascii=False)
+        by_month.setdefault((timestamp or "unknown")[:7], []).append(line)
+    for month, lines in by_month.items():
+        path = os.path.join(ARCHIVE_DIR, f"requests-{month}.jsonl.gz")
+        with open(path, "ab") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+            f.write(("\n".join(lines) + "\n").encode("utf-8"))
+            f.flush()
+            os.fsync(raw.fileno())
+
+def archive_requests(cutoff: str, dry_run: bool = RETENTION_DRY_RUN) -> int:
+    """
+    Выгружает запросы старше cutoff ('YYYY-MM-DD HH:MM:SS', UTC) в архив и удаляет их пачками.
+    Возвращает число обработанных строк. Статистика от этого не меняется: отчёты строятся по сводкам.
+    """
+    conn = _get_conn()
+    if dry_run:
+        return conn.execute("SELECT COUNT(*) FROM requests WHERE timestamp < ?", (cutoff,)).fetchone()[0]
+    total = 0
+    while not _stop.is_set():
+        rows = conn.execute("""
+            SELECT id, user_id, request_type, model_used, voice_used, timestamp FROM requests
+            WHERE timestamp < ? ORDER BY timestamp, id LIMIT ?
+        """, (cutoff, RETENTION_BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        # Сначала архив на диске, потом удаление: при сбое строки не теряются
+        _append_archive(rows)
+        with conn:
+            conn.executemany("DELETE FROM requests WHERE id = ?", [(row[0],) for row in rows])
+        total += len(rows)
+        metrics.inc(ROWS_TOTAL, len(rows), action="archived")
+        time.sleep(RETENTION_BATCH_PAUSE)
+    return total
+
+def rollup_hourly(cutoff_day: str, dry_run: bool = RETENTION_DRY_RUN) -> int:
+    """
+    Сворачивает почасовую сводку за дни раньше cutoff_day ('YYYY-MM-DD') в requests_daily,
+    по одному дню за транзакцию. Возвращает число свёрнутых почасовых строк.
+    """
+    conn = _get_conn()
+    if dry_run:
+        return conn.execute("SELECT COUNT(*) FROM requests_hourly WHERE hour < ?", (cutoff_day,)).fetchone()[0]
+    total = 0
+    while not _stop.is_set():
+        row = conn.execute("SELECT MIN(hour) FROM requests_hourly WHERE hour < ?", (cutoff_day,)).fetchone()
+        if row[0] is None:
+            break
+        day = row[0][:10]
+        next_day = (datetime.strptime(day, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+        with conn:
+            conn.execute("""
+                INSERT INTO requests_daily (day, user_id, request_type, model_used, voice_used, requests)
+                SELECT ?, user_id, request_type, model_used, voice_used, SUM(requests)
+                FROM requests_hourly WHERE hour >= ? AND hour < ?
+                GROUP BY user_id, request_type, model_used, voice_used
+                ON CONFLICT(day, user_id, request_type, model_used, voice_used)
+                DO UPDATE SET requests = requests + excluded.requests
+            """, (day, day, next_day))
+            deleted = conn.execute(
+                "DELETE FROM requests_hourly WHERE hour >= ? AND hour < ?", (day, next_day)
+            ).rowcount
+        total += deleted
+        metrics.inc(ROWS_TOTAL, deleted, action="rolled_up")
+        time.sleep(RETENTION_BATCH_PAUSE)
+    return total
+
+def run_once(now: datetime = None, dry_run: bool = RETENTION_DRY_RUN) -> dict:
+    """Один проход обслуживания: сворачивание почасовой сводки и архивация старых запросов."""
+    now = now or datetime.utcnow()
+    started = time.monotonic()
+    result = {"dry_run": dry_run}
+    result["hourly_rolled_up"] = rollup_hourly((now - timedelta(days=HOURLY_RETENTION_DAYS)).strftime("%Y-%m-%d"), dry_run)
+    if REQUESTS_RETENTION_DAYS > 0:
+        cutoff = (now - timedelta(days=REQUESTS_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        result["requests_archived"] = archive_requests(cutoff, dry_run)
+    result["seconds"] = round(time.monotonic() - started, 2)
+    logger.info("Обслуживание БД%s: %s", " (dry-run)" if dry_run else "", result)
+    return result
+
+async def _loop():
+    await asyncio.sleep(RETENTION_INITIAL_DELAY)
+    while not _stop.is_set():
+        try:
+            await asyncio.to_thread(run_once)
+        except Exception as e:
+            logger.error("Ошибка обслуживания БД: %s", e, exc_info=e)
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+def start():
+    """Запускает периодическое обслуживание в фоне (вызывается при старте бота)."""
+    global _task
+    if _task is None or _task.done():
+        _stop.clear()
+        _task = asyncio.create_task(_loop())
+
+def stop():
+    """Останавливает обслуживание: текущая пачка дописывается, новые не начинаются."""
+    _stop.set()
+    if _task is not None:
+        _task.cancel()
@@ -0,0 +1,237 @@
+from dotenv import load_dotenv
+load_dotenv()  # Загружаем переменные окружения
+
+import os
+import sys
+import json
+import signal
+import asyncio
+import logging
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram import Bot, Update
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "").rstrip("/")
+# Если задан WEBHOOK_URL, апдейты принимаются вебхуком, иначе – long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+POLL_TIMEOUT = int(os.getenv("SHARD_POLL_TIMEOUT", "30"))
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "10000"))
+# Сколько ждать остановки воркера: он дожидается выполняющихся задач (DRAIN_TIMEOUT) и сохраняет снимок
+SHUTDOWN_TIMEOUT = float(os.getenv("SHARD_SHUTDOWN_TIMEOUT", str(float(os.getenv("DRAIN_TIMEOUT", "60")) + 30)))
+
+def extract_user_id(data: dict) -> int:
+    """Находит id отправителя в сыром апдейте (message.from, callback_query.from, ...); 0, если его нет."""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            sender = value.get(field)
+            if isinstance(sender, dict) and "id" in sender:
+                return sender["id"]
+    return 0
+
+def shard_for(data: dict, workers: int) -> int:
+    """Номер воркера для апдейта: все апдейты одного пользователя попадают в один процесс."""
+    return abs(extract_user_id(data)) % workers
+
+# --- Воркер ---
+
+async def _worker(index: int, updates):
+    import telegram_bot
+    import metrics
+    import lifecycle
+    import admin
+    import error_digest
+    import db
+    if metrics.METRICS_PORT:
+        # Каждый воркер отдаёт свои метрики на отдельном порту
+        metrics.start_http_server(metrics.METRICS_PORT + index)
+    # Апдейты обрабатываются последовательно, чтобы сохранить порядок сообщений каждого пользователя
+    application = telegram_bot.build_application(updater=False, concurrent_updates=False)
+    await application.initialize()
+    # Схема уже создана распределителем; здесь только открывается соединение – вне event loop
+    await asyncio.to_thread(db.init_db)
+    if index == 0:
+        # Общие фоновые задачи (например, возобновление рассылок) выполняет только один воркер
+        await telegram_bot.on_startup(application)
+    else:
+        await lifecycle.restore(application)
+        # Ошибки своего шарда каждый воркер учитывает и отправляет админам сам
+        error_digest.start(application.bot, admin.ADMIN_IDS)
+    await application.start()
+    logger.info("Воркер %s запущен", index)
+    try:
+        while True:
+            data = await asyncio.to_thread(updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        await lifecycle.drain(application)
+        await application.shutdown()
+        await telegram_bot.on_shutdown(application)
+        logger.info("Воркер %s остановлен", index)
+
+def worker_main(index: int, workers: int, updates):
+    """Точка входа процесса-воркера: выполняет обычные обработчики для своей доли пользователей."""
+    # Остановкой управляет процесс-распределитель
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(
+        format=f"%(asctime)s - shard-{index} - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    import tts_cache
+    import tts_queue
+    import lifecycle
+    # Общий лимит одновременных задач к API делится между воркерами (остаток – первым)
+    tts_queue.queue = tts_queue.FairQueue(
+        max(1, tts_queue.TTS_WORKERS // workers + (index < tts_queue.TTS_WORKERS % workers)),
+        tts_queue.TTS_PER_USER_INFLIGHT, tts_queue.TTS_PER_USER_QUEUE,
+    )
+    # У каждого воркера свой каталог кэша: индекс LRU хранится в памяти процесса
+    tts_cache.cache = tts_cache.TTSCache(
+        os.path.join(tts_cache.CACHE_DIR, f"shard-{index}"), tts_cache.CACHE_MAX_BYTES // workers
+    )
+    # и свой снимок состояния для перезапуска
+    root, ext = os.path.splitext(lifecycle.SNAPSHOT_PATH)
+    lifecycle.SNAPSHOT_PATH = f"{root}.shard-{index}{ext}"
+    # Перезапуск и выключение из админки выполняет распределитель для всех воркеров сразу
+    lifecycle.dispatcher_pid = os.getppid()
+    asyncio.run(_worker(index, updates))
+
+# --- Приём апдейтов ---
+
+def _dispatch(queues, data: dict):
+    queues[shard_for(data, len(queues))].put(data)
+
+def _bot() -> Bot:
+    if TELEGRAM_API_BASE:
+        return Bot(TELEGRAM_BOT_TOKEN, base_url=f"{TELEGRAM_API_BASE}/bot", base_file_url=f"{TELEGRAM_API_BASE}/file/bot")
+    return Bot(TELEGRAM_BOT_TOKEN)
+
+async def _poll(queues):
+    async with _bot() as bot:
+        await bot.delete_webhook()
+        offset = None
+        try:
+            while True:
+                try:
+                    updates = await bot.get_updates(
+                        offset=offset, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES,
+                        read_timeout=POLL_TIMEOUT + 10,
+                    )
+                except Exception as e:
+                    logger.error("Ошибка получения апдейтов: %s", e)
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    _dispatch(queues, update.to_dict())
+                    offset = update.update_id + 1
+        finally:
+            if offset is not None:
+                # Подтверждаем уже розданные апдейты, чтобы после перезапуска они не пришли повторно
+                try:
+                    await bot.get_updates(offset=offset, timeout=0, limit=1)
+                except Exception as e:
+                    logger.warning("Не удалось подтвердить полученные апдейты: %s", e)
+
+def _serve_webhook(queues):
+    async def register():
+        async with _bot() as bot:
+            await bot.set_webhook(
+                WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None, allowed_updates=Update.ALL_TYPES
+            )
+    asyncio.run(register())
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if WEBHOOK_SECRET and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+                self.send_response(403)
+                self.end_headers()
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                data = json.loads(self.rfile.read(length))
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                return
+            _dispatch(queues, data)
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookHandler)
+    logger.info("Вебхук слушает %s:%s", WEBHOOK_LISTEN, WEBHOOK_PORT)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+_restart_requested = False
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def _request_restart(signum, frame):
+    global _restart_requested
+    _restart_requested = True
+    raise KeyboardInterrupt
+
+def _cancel_restart(signum, frame):
+    # SIGTERM во время остановки: воркеры всё равно дорабатывают, но без перезапуска
+    global _restart_requested
+    _restart_requested = False
+
+def run(workers: int):
+    """
+    Запускает workers процессов-воркеров и принимает апдейты в текущем процессе,
+    раздавая их по хэшу user_id. Все воркеры пишут в общую БД (WAL).
+    SIGTERM останавливает всех воркеров, SIGUSR1 (перезапуск из админки) после этого
+    перезапускает распределитель вместе с новыми воркерами.
+    """
+    import db
+    # Миграции и построение сводок выполняются один раз до запуска воркеров, а не в каждом из них
+    db.init_db()
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue(SHARD_QUEUE_SIZE) for _ in range(workers)]
+    processes = [
+        ctx.Process(target=worker_main, args=(i, workers, queues[i]), name=f"shard-{i}")
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+    signal.signal(signal.SIGUSR1, _request_restart)
+    logger.info("Запущено воркеров: %s", workers)
+    try:
+        if WEBHOOK_URL:
+            _serve_webhook(queues)
+        else:
+            asyncio.run(_poll(queues))
+    except KeyboardInterrupt:
+        logger.info("Остановка распределителя...")
+    finally:
+        # Повторные сигналы не должны прерывать ожидание воркеров
+        signal.signal(signal.SIGTERM, _cancel_restart)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        for updates in queues:
+            updates.put(None)
+        for process in processes:
+            process.join(SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                logger.warning("Воркер %s не остановился вовремя, завершаем принудительно", process.name)
+                process.terminate()
+    if _restart_requested:
+        logger.info("Перезапуск распределителя...")
+        python = sys.executable
+        os.execv(python, [python] + sys.argv)
@@ -0,0 +1,37 @@
+import asyncio
+import logging
+import metrics
+
+logger = logging.getLogger(__name__)
+
+COALESCED = "bot_singleflight_coalesced_total"
+
+class SingleFlight:
+    """
+    Объединяет одновременные одинаковые вызовы: пока выполняется func() для ключа,
+    остальные вызовы с тем же ключом ждут и получают тот же результат (или ту же ошибку).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}  # key -> asyncio.Task
+
+    def _forget(self, key, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Ошибка передаётся ожидающим; если их не осталось, не даём asyncio ругаться на неё
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, func):
+        """Возвращает результат func() для key, выполняя не более одного вызова одновременно."""
+        task = self._calls.get(key)
+        if task is None:
+            # Отдельная задача: отмена одного из ожидающих не прерывает работу для остальных
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            metrics.inc(COALESCED, flight=self.name)
+            logger.debug("Запрос %s %s присоединён к уже выполняющемуся", self.name, key)
+        return await asyncio.shield(task)
@@ -0,0 +1,108 @@
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+import db
+
+# Максимальная длина сообщения Telegram
+MAX_MESSAGE_LENGTH = 4096
+
+# Отдельное соединение для отчётов, чтобы не делить курсор с горячим путём
+_conn = None
+_lock = threading.Lock()
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        db.init_db()
+        _conn = sqlite3.connect(db.DB_PATH, check_same_thread=False, timeout=30)
+    return _conn
+
+def percentile(values, p):
+    """Перцентиль p (0..100) по отсортированному списку методом ближайшего ранга."""
+    if not values:
+        return 0
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+def _hour_floor(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%d %H:00")
+
+def collect_stats(now: datetime = None) -> dict:
+    """
+    Считает агрегаты по почасовой сводке requests_hourly (а не по сырой таблице requests),
+    поэтому время ответа не зависит от числа накопленных запросов.
+    """
+    now = now or datetime.utcnow()
+    today = _hour_floor(now.replace(hour=0))
+    week = _hour_floor(now - timedelta(days=7))
+    month_start = _hour_floor(now.replace(day=1, hour=0))
+    last_30 = _hour_floor(now - timedelta(days=30))
+    with _lock:
+        conn = _get_conn()
+
+        def scalar(sql, params=()):
+            return conn.execute(sql, params).fetchone()[0] or 0
+
+        result = {
+            "users_total": scalar("SELECT COUNT(*) FROM users"),
+            # Старые часы свёрнуты в дневную сводку (см. retention)
+            "requests_total": scalar("SELECT SUM(requests) FROM requests_hourly")
+                + scalar("SELECT SUM(requests) FROM requests_daily"),
+            "active_today": scalar("SELECT COUNT(DISTINCT user_id) FROM requests_hourly WHERE hour >= ?", (today,)),
+            "active_week": scalar("SELECT COUNT(DISTINCT user_id) FROM requests_hourly WHERE hour >= ?", (week,)),
+            "active_month": scalar("SELECT COUNT(DISTINCT user_id) FROM requests_hourly WHERE hour >= ?", (month_start,)),
+            "daily": conn.execute("""
+                SELECT substr(hour, 1, 10) AS day, COUNT(DISTINCT user_id), SUM(requests)
+                FROM requests_hourly WHERE hour >= ?
+                GROUP BY day ORDER BY day DESC
+            """, (week,)).fetchall(),
+        }
+        for column in ("request_type", "model_used", "voice_used"):
+            result[column] = conn.execute(f"""
+                SELECT {column}, SUM(requests) AS n FROM requests_hourly
+                WHERE hour >= ? GROUP BY {column} ORDER BY n DESC
+            """, (last_30,)).fetchall()
+        per_user = conn.execute("""
+            SELECT user_id, SUM(requests) AS n FROM requests_hourly
+            WHERE hour >= ? GROUP BY user_id ORDER BY n DESC
+        """, (last_30,)).fetchall()
+        top_ids = [row[0] for row in per_user[:10]]
+        names = {}
+        if top_ids:
+            placeholders = ",".join("?" * len(top_ids))
+            names = dict(conn.execute(
+                f"SELECT user_id, COALESCE(username, first_name, '') FROM users WHERE user_id IN ({placeholders})",
+                top_ids,
+            ).fetchall())
+    volumes = sorted(row[1] for row in per_user)
+    result["top_users"] = [(user_id, names.get(user_id, ""), n) for user_id, n in per_user[:10]]
+    result["p50"] = percentile(volumes, 50)
+    result["p95"] = percentile(volumes, 95)
+    return result
+
+def build_report() -> str:
+    """Текстовый отчёт для админ-панели, укороченный до лимита сообщения Telegram."""
+    s = collect_stats()
+    lines = [
+        "DB Statistics:",
+        "",
+        f"Users: {s['users_total']}",
+        f"Requests total: {s['requests_total']}",
+        f"Active users: today {s['active_today']}, 7d {s['active_week']}, month {s['active_month']}",
+        "",
+        "Last 7 days (day: active users / requests):",
+    ]
+    lines += [f"{day}: {users} / {n}" for day, users, n in s["daily"]]
+    for title, column in (("type", "request_type"), ("model", "model_used"), ("voice", "voice_used")):
+        lines.append("")
+        lines.append(f"Requests by {title} (30d):")
+        lines += [f"{value or '-'}: {n}" for value, n in s[column]]
+    lines.append("")
+    lines.append("Top users (30d):")
+    lines += [f"{user_id} {name}: {n}" for user_id, name, n in s["top_users"]]
+    lines.append("")
+    lines.append(f"Requests per active user (30d): p50 {s['p50']}, p95 {s['p95']}")
+    text = "\n".join(lines)
+    if len(text) > MAX_MESSAGE_LENGTH:
+        text = text[:MAX_MESSAGE_LENGTH - 1] + "…"
+    return text
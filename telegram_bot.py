@@ -1,9 +1,9 @@
 import os
-import tempfile
+import io
 import logging
-import requests
-import traceback
+import asyncio
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -16,24 +16,56 @@ from dotenv import load_dotenv
 import openai
 import db
 import admin
+import api_client
+import tts_cache
+import tts_pipeline
+import audio_split
+import broadcast
+import tts_queue
+import metrics
+import resilience
+import lifecycle
+import retention
+import error_digest
+from persistence import SQLitePersistence
+from singleflight import SingleFlight
 
 # Загружаем переменные окружения
 load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 ADMIN_IDS_STR = os.getenv("ADMIN_IDS", "")  # Например, "548028141"
+# Сколько апдейтов обрабатывается одновременно (долгие TTS-запросы не блокируют остальных)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+# Голосовые длиннее этого (сек) режутся по паузам и распознаются параллельно
+VOICE_SPLIT_SECONDS = float(os.getenv("VOICE_SPLIT_SECONDS", "120"))
+VOICE_SEGMENT_CONCURRENCY = int(os.getenv("VOICE_SEGMENT_CONCURRENCY", "4"))
+# Адрес Bot API (например, локальный сервер или тестовая заглушка); по умолчанию – api.telegram.org
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "").rstrip("/")
+# Число процессов-воркеров в режиме шардов (0 – обычный однопроцессный режим)
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))
+# Аудио до этого размера держим в памяти, больше – сбрасываем во временный файл
+TTS_SPOOL_MAX_BYTES = int(os.getenv("TTS_SPOOL_MAX_BYTES", str(8 * 1024 * 1024)))
+# Настройки по умолчанию: модель (auto, tts-1, tts-1-hd) и формат ответа (audio – MP3, voice – голосовое Opus)
+DEFAULT_TTS_MODEL = os.getenv("DEFAULT_TTS_MODEL", "auto")
+DEFAULT_TTS_FORMAT = os.getenv("DEFAULT_TTS_FORMAT", "audio")
 if not TELEGRAM_BOT_TOKEN or not OPENAI_API_KEY:
     raise RuntimeError("Укажите TELEGRAM_BOT_TOKEN и OPENAI_API_KEY в файле .env")
 
 # Настраиваем OpenAI
 openai.api_key = OPENAI_API_KEY
-openai.api_base = "https://api.proxyapi.ru/openai/v1"
+openai.api_base = os.getenv("OPENAI_API_BASE", "https://api.proxyapi.ru/openai/v1")
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
+TTS_BYTES_SENT = "bot_tts_bytes_sent_total"
+
+# Синтез, который сейчас выполняется, по ключу кэша
+tts_flight = SingleFlight("tts")
+
 # Постоянная клавиатура – кнопка для смены настроек
 persistent_keyboard = ReplyKeyboardMarkup(
     [["Сменить настройки"]],
@@ -41,36 +73,177 @@ persistent_keyboard = ReplyKeyboardMarkup(
     one_time_keyboard=False,
 )
 
-def generate_tts_audio(model: str, voice: str, input_text: str, instructions: str, audio_path: str):
-    url = f"{openai.api_base}/audio/speech"
+async def stream_tts_audio(model: str, voice: str, input_text: str, instructions: str, out, response_format: str = "mp3"):
+    """Запрашивает синтез одного куска текста и пишет ответ API потоково в файловый объект out."""
     headers = {
         "Authorization": f"Bearer {openai.api_key}",
         "Content-Type": "application/json",
     }
-    payload = {"model": model, "voice": voice, "input": input_text}
+    payload = {"model": model, "voice": voice, "input": input_text, "response_format": response_format}
     if instructions:
         payload["instructions"] = instructions
-    with requests.post(url, headers=headers, json=payload, stream=True) as r:
-        r.raise_for_status()
-        with open(audio_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
+    client = api_client.get_client()
+    with metrics.upstream("upstream_tts", model=model, voice=voice):
+        r = await resilience.send(
+            "upstream_tts", openai.api_base,
+            lambda base: client.build_request("POST", f"{base}/audio/speech", headers=headers, json=payload),
+        )
+        try:
+            async for chunk in r.aiter_bytes(chunk_size=8192):
                 if chunk:
-                    f.write(chunk)
+                    out.write(chunk)
+        finally:
+            await r.aclose()
+
+async def generate_tts_audio(model: str, voice: str, input_text: str, instructions: str, out, response_format: str = "mp3"):
+    """
+    Озвучивает текст и пишет аудио в файловый объект out.
+    Длинные тексты синтезируются по кускам и склеиваются – это возможно только для MP3.
+    """
+    if len(input_text) <= tts_pipeline.MAX_INPUT_CHARS:
+        await stream_tts_audio(model, voice, input_text, instructions, out, response_format)
+        return
+    if response_format != "mp3":
+        raise ValueError("Длинный текст можно озвучить только в MP3")
+
+    async def synthesize(chunk: str) -> bytes:
+        buf = io.BytesIO()
+        await stream_tts_audio(model, voice, chunk, instructions, buf)
+        return buf.getvalue()
+
+    # Длинный текст: куски синтезируются параллельно и склеиваются по порядку
+    await tts_pipeline.synthesize_long_text(input_text, synthesize, out)
 
-def transcribe_voice_file(audio_path: str) -> dict:
-    url = f"{openai.api_base}/audio/transcriptions"
+async def transcribe_audio(data: bytes, filename: str = "voice.ogg") -> dict:
+    """Отправляет аудио из памяти на /audio/transcriptions."""
     headers = {"Authorization": f"Bearer {openai.api_key}"}
-    data = {"model": "whisper-1"}
-    with open(audio_path, "rb") as audio_file:
-        files = {"file": audio_file}
-        response = requests.post(url, headers=headers, data=data, files=files)
-        response.raise_for_status()
-        return response.json()
+    form = {"model": "whisper-1"}
+    files = {"file": (filename, data, "audio/ogg")}
+    client = api_client.get_client()
+    with metrics.upstream("upstream_transcription"):
+        response = await resilience.send(
+            "upstream_transcription", openai.api_base,
+            lambda base: client.build_request(
+                "POST", f"{base}/audio/transcriptions", headers=headers, data=form, files=files
+            ),
+        )
+        try:
+            await response.aread()
+        finally:
+            await response.aclose()
+    return response.json()
+
+async def transcribe_voice(data: bytes, duration: float) -> str:
+    """
+    Транскрибирует голосовое сообщение. Длинные записи режутся по паузам (если есть ffmpeg),
+    сегменты распознаются параллельно и склеиваются по порядку.
+    """
+    if duration > VOICE_SPLIT_SECONDS and audio_split.available():
+        try:
+            segments = await audio_split.split_on_silence(data, duration)
+        except Exception as e:
+            logger.warning("Не удалось разбить голосовое сообщение, распознаём целиком: %s", e)
+            segments = [data]
+    else:
+        segments = [data]
+    if len(segments) == 1:
+        return (await transcribe_audio(segments[0])).get("text", "")
+    semaphore = asyncio.Semaphore(VOICE_SEGMENT_CONCURRENCY)
+
+    async def transcribe_segment(segment: bytes) -> str:
+        async with semaphore:
+            return (await transcribe_audio(segment)).get("text", "").strip()
+
+    texts = await asyncio.gather(*(transcribe_segment(segment) for segment in segments))
+    return " ".join(text for text in texts if text)
+
+async def _store_in_cache(key: str, audio: tts_cache.SynthesizedAudio):
+    try:
+        with metrics.timer("disk_write"):
+            await asyncio.to_thread(tts_cache.cache.store, key, audio)
+    except Exception as e:
+        logger.error("Не удалось сохранить озвучку в кэш: %s", e)
+
+async def synthesize_to_cache(key: str, model: str, voice: str, input_text: str, instructions: str, fmt: str) -> tts_cache.SynthesizedAudio:
+    """
+    Озвучивает текст и возвращает аудио; запись в кэш запускается в фоне и идёт параллельно с отправкой.
+    Ответ API пишется в память, большие файлы – во временный файл в каталоге кэша.
+    """
+    spool = tts_cache.AudioSpool(tts_cache.cache.directory, TTS_SPOOL_MAX_BYTES)
+    try:
+        await generate_tts_audio(
+            model=model,
+            voice=voice,
+            input_text=input_text,
+            instructions=instructions,
+            out=spool,
+            response_format=fmt,
+        )
+    except BaseException:
+        spool.discard()
+        raise
+    audio = spool.finish()
+    audio.stored = asyncio.create_task(_store_in_cache(key, audio))
+    return audio
+
+def resolve_model(setting: str, document: bool = False) -> str:
+    """Модель для запроса: в режиме auto – быстрая tts-1 для сообщений и tts-1-hd для файлов."""
+    if setting == "auto":
+        return "tts-1-hd" if document else "tts-1"
+    return setting
+
+async def send_tts_reply(update: Update, audio, as_voice: bool, source: str, size: int = 0):
+    """Отправляет озвучку голосовым (Opus) или аудиофайлом (MP3); возвращает отправленный файл Telegram."""
+    mode = "voice" if as_voice else "audio"
+    with metrics.timer("telegram_upload", source=source, mode=mode):
+        if as_voice:
+            sent = await update.message.reply_voice(voice=audio, filename="audio.ogg", reply_markup=persistent_keyboard)
+        else:
+            sent = await update.message.reply_audio(audio=audio, filename="audio.mp3", reply_markup=persistent_keyboard)
+    if size:
+        metrics.inc(TTS_BYTES_SENT, size, mode=mode, source=source)
+    return sent.voice if as_voice else sent.audio
+
+async def reply_tts(update: Update, model: str, voice: str, input_text: str, instructions: str, as_voice: bool = False):
+    """
+    Отправляет озвучку текста пользователю, используя кэш:
+    сначала Telegram file_id (без загрузки файла), затем аудио с диска, и только потом запрос к API.
+    as_voice – голосовое сообщение в Opus вместо MP3 (меньше размер и быстрее загрузка).
+    """
+    # Длинные тексты склеиваются из кусков, что возможно только для MP3
+    as_voice = as_voice and len(input_text) <= tts_pipeline.MAX_INPUT_CHARS
+    fmt = "opus" if as_voice else "mp3"
+    key = tts_cache.make_key(model, voice, instructions, input_text, fmt)
+    with metrics.timer("time_to_audio", mode="voice" if as_voice else "audio"):
+        file_id = tts_cache.cache.get_file_id(key)
+        if file_id:
+            try:
+                await send_tts_reply(update, file_id, as_voice, "file_id")
+                return
+            except BadRequest as e:
+                logger.warning("Закэшированный file_id не принят Telegram: %s", e)
+                tts_cache.cache.forget_file_id(key)
+        audio_path = tts_cache.cache.get_path(key)
+        if audio_path is not None:
+            with open(audio_path, "rb") as audio_file:
+                sent = await send_tts_reply(update, audio_file, as_voice, "cache", os.path.getsize(audio_path))
+        else:
+            # Одинаковые одновременные запросы (разные чаты, повторные нажатия) делят один вызов API
+            audio = await tts_flight.do(key, lambda: synthesize_to_cache(key, model, voice, input_text, instructions, fmt))
+            with audio.open() as source:
+                sent = await send_tts_reply(update, source, as_voice, "upstream", audio.size)
+    if sent:
+        if audio_path is None:
+            # file_id запоминается для записи кэша, поэтому ждём её (уже вне time_to_audio)
+            await audio.stored
+        tts_cache.cache.set_file_id(key, sent.file_id)
 
 def build_settings_keyboard(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
-    current_model = context.user_data.get("tts_model", "tts-1-hd")
+    current_model = context.user_data.get("tts_model", DEFAULT_TTS_MODEL)
     current_voice = context.user_data.get("tts_voice", "nova")
+    current_format = context.user_data.get("tts_format", DEFAULT_TTS_FORMAT)
     model_buttons = [
+        InlineKeyboardButton(f"auto{' ✅' if current_model == 'auto' else ''}", callback_data="model:auto"),
         InlineKeyboardButton(f"tts-1{' ✅' if current_model == 'tts-1' else ''}", callback_data="model:tts-1"),
         InlineKeyboardButton(f"tts-1-hd{' ✅' if current_model == 'tts-1-hd' else ''}", callback_data="model:tts-1-hd")
     ]
@@ -83,7 +256,11 @@ def build_settings_keyboard(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboar
         InlineKeyboardButton(f"shimmer{' ✅' if current_voice == 'shimmer' else ''}", callback_data="voice:shimmer")
     ]
     voice_rows = [voice_buttons[i:i+3] for i in range(0, len(voice_buttons), 3)]
-    keyboard = [model_buttons] + voice_rows
+    format_buttons = [
+        InlineKeyboardButton(f"Аудио MP3{' ✅' if current_format == 'audio' else ''}", callback_data="format:audio"),
+        InlineKeyboardButton(f"Голосовое{' ✅' if current_format == 'voice' else ''}", callback_data="format:voice")
+    ]
+    keyboard = [model_buttons] + voice_rows + [format_buttons]
     return InlineKeyboardMarkup(keyboard)
 
 async def send_startup_message(application: Application):
@@ -101,7 +278,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Привет! Я TTS‑бот:\n\n"
         "• Отправь текст или текстовый файл (.txt) – я верну озвучку.\n"
         "• Отправь голосовое сообщение – я выполню транскрипцию через Whisper.\n\n"
-        "Нажми «Сменить настройки», чтобы выбрать модель и голос."
+        "Нажми «Сменить настройки», чтобы выбрать модель, голос и формат ответа."
     )
     user = update.message.from_user
     db.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
@@ -119,9 +296,38 @@ async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT
         context.user_data["tts_model"] = data.split(":", 1)[1]
     elif data.startswith("voice:"):
         context.user_data["tts_voice"] = data.split(":", 1)[1]
+    elif data.startswith("format:"):
+        context.user_data["tts_format"] = data.split(":", 1)[1]
     reply_markup = build_settings_keyboard(context)
     await query.edit_message_text(text="Настройки обновлены:", reply_markup=reply_markup)
 
+async def enqueue_job(update: Update, func, start_text: str = None):
+    """Ставит задачу в очередь к API и сообщает пользователю о начале обработки или о месте в очереди."""
+    try:
+        job = tts_queue.queue.submit(update.message.from_user.id, func, payload=update.to_dict())
+    except tts_queue.QueueFull:
+        await update.message.reply_text(
+            "У вас слишком много запросов в очереди. Дождитесь их выполнения или отправьте /cancel.",
+            reply_markup=persistent_keyboard,
+        )
+        return
+    place = tts_queue.queue.position(job)
+    if place:
+        await update.message.reply_text(
+            f"Вы #{place} в очереди. Отменить ожидающие запросы: /cancel",
+            reply_markup=persistent_keyboard,
+        )
+    elif start_text:
+        await update.message.reply_text(start_text, reply_markup=persistent_keyboard)
+
+async def cancel_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отменяет ещё не начатые запросы пользователя."""
+    cancelled = tts_queue.queue.cancel_user(update.message.from_user.id)
+    if cancelled:
+        await update.message.reply_text(f"Отменено запросов: {cancelled}.", reply_markup=persistent_keyboard)
+    else:
+        await update.message.reply_text("Нет запросов в очереди.", reply_markup=persistent_keyboard)
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     db.add_or_update_user(user.id, user.username, user.first_name, user.last_name)
@@ -132,29 +338,22 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if text.strip().lower() == "сменить настройки":
         await set_settings(update, context)
         return
-    await update.message.reply_text("Генерирую аудио...", reply_markup=persistent_keyboard)
-    tts_model = context.user_data.get("tts_model", "tts-1-hd")
+    tts_model = resolve_model(context.user_data.get("tts_model", DEFAULT_TTS_MODEL))
     tts_voice = context.user_data.get("tts_voice", "nova")
+    as_voice = context.user_data.get("tts_format", DEFAULT_TTS_FORMAT) == "voice"
     instructions = ""
-    with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tf:
-        audio_path = tf.name
-    try:
-        generate_tts_audio(
-            model=tts_model,
-            voice=tts_voice,
-            input_text=text,
-            instructions=instructions,
-            audio_path=audio_path,
-        )
-        with open(audio_path, "rb") as audio_file:
-            await update.message.reply_audio(audio=audio_file, reply_markup=persistent_keyboard)
-        db.log_request(user.id, "TTS", model_used=tts_model, voice_used=tts_voice)
-    except Exception as e:
-        logger.error("Ошибка при генерации аудио: %s", e)
-        await update.message.reply_text("Ошибка при генерации аудио: " + str(e), reply_markup=persistent_keyboard)
-    finally:
-        if os.path.exists(audio_path):
-            os.remove(audio_path)
+
+    async def job():
+        try:
+            await reply_tts(update, tts_model, tts_voice, text, instructions, as_voice=as_voice)
+            db.log_request(user.id, "TTS", model_used=tts_model, voice_used=tts_voice)
+        except resilience.UpstreamUnavailable:
+            await update.message.reply_text(resilience.UNAVAILABLE_TEXT, reply_markup=persistent_keyboard)
+        except Exception as e:
+            logger.error("Ошибка при генерации аудио: %s", e)
+            await update.message.reply_text("Ошибка при генерации аудио: " + str(e), reply_markup=persistent_keyboard)
+
+    await enqueue_job(update, job, "Генерирую аудио...")
 
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
@@ -163,37 +362,26 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not document:
         await update.message.reply_text("Документ не найден.", reply_markup=persistent_keyboard)
         return
-    file = await document.get_file()
-    try:
-        with tempfile.NamedTemporaryFile(suffix=".txt", delete=False) as tf:
-            file_path = tf.name
-        await file.download_to_drive(custom_path=file_path)
-        with open(file_path, "r", encoding="utf-8") as f:
-            text = f.read()
-        await update.message.reply_text("Генерирую аудио из файла...", reply_markup=persistent_keyboard)
-        tts_model = context.user_data.get("tts_model", "tts-1-hd")
-        tts_voice = context.user_data.get("tts_voice", "nova")
-        instructions = ""
-        with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tf_audio:
-            audio_path = tf_audio.name
-        generate_tts_audio(
-            model=tts_model,
-            voice=tts_voice,
-            input_text=text,
-            instructions=instructions,
-            audio_path=audio_path,
-        )
-        with open(audio_path, "rb") as audio_file:
-            await update.message.reply_audio(audio=audio_file, reply_markup=persistent_keyboard)
-        db.log_request(user.id, "File", model_used=tts_model, voice_used=tts_voice)
-    except Exception as e:
-        logger.error("Ошибка при обработке файла: %s", e)
-        await update.message.reply_text("Ошибка при обработке файла: " + str(e), reply_markup=persistent_keyboard)
-    finally:
-        if 'file_path' in locals() and os.path.exists(file_path):
-            os.remove(file_path)
-        if 'audio_path' in locals() and os.path.exists(audio_path):
-            os.remove(audio_path)
+    # Файлы – обычно длинные тексты для прослушивания: всегда MP3, в режиме auto – tts-1-hd
+    tts_model = resolve_model(context.user_data.get("tts_model", DEFAULT_TTS_MODEL), document=True)
+    tts_voice = context.user_data.get("tts_voice", "nova")
+    instructions = ""
+
+    async def job():
+        try:
+            with metrics.timer("telegram_download", kind="document"):
+                file = await document.get_file()
+                content = await file.download_as_bytearray()
+            text = content.decode("utf-8")
+            await reply_tts(update, tts_model, tts_voice, text, instructions)
+            db.log_request(user.id, "File", model_used=tts_model, voice_used=tts_voice)
+        except resilience.UpstreamUnavailable:
+            await update.message.reply_text(resilience.UNAVAILABLE_TEXT, reply_markup=persistent_keyboard)
+        except Exception as e:
+            logger.error("Ошибка при обработке файла: %s", e)
+            await update.message.reply_text("Ошибка при обработке файла: " + str(e), reply_markup=persistent_keyboard)
+
+    await enqueue_job(update, job, "Генерирую аудио из файла...")
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
@@ -202,50 +390,93 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not voice:
         await update.message.reply_text("Голосовое сообщение не найдено.", reply_markup=persistent_keyboard)
         return
-    file = await voice.get_file()
-    try:
-        with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as tf:
-            voice_path = tf.name
-        await file.download_to_drive(custom_path=voice_path)
-        transcript = transcribe_voice_file(voice_path)
-        await update.message.reply_text(transcript.get("text", "Нет текста"), reply_markup=persistent_keyboard)
-        db.log_request(user.id, "Voice", model_used=context.user_data.get("tts_model"), voice_used=context.user_data.get("tts_voice"))
-    except Exception as e:
-        logger.error("Ошибка при транскрипции голосового сообщения: %s", e)
-        await update.message.reply_text("Ошибка при транскрипции голосового сообщения: " + str(e), reply_markup=persistent_keyboard)
-    finally:
-        if os.path.exists(voice_path):
-            os.remove(voice_path)
+    tts_model = context.user_data.get("tts_model")
+    tts_voice = context.user_data.get("tts_voice")
+
+    async def job():
+        try:
+            # Пересланные голосовые имеют тот же file_unique_id – отдаём готовую транскрипцию
+            text = db.get_transcript(voice.file_unique_id)
+            if text is None:
+                with metrics.timer("telegram_download", kind="voice"):
+                    file = await voice.get_file()
+                    data = bytes(await file.download_as_bytearray())
+                text = await transcribe_voice(data, voice.duration or 0)
+                db.save_transcript(voice.file_unique_id, text)
+            await update.message.reply_text(text or "Нет текста", reply_markup=persistent_keyboard)
+            db.log_request(user.id, "Voice", model_used=tts_model, voice_used=tts_voice)
+        except resilience.UpstreamUnavailable:
+            await update.message.reply_text(resilience.UNAVAILABLE_TEXT, reply_markup=persistent_keyboard)
+        except Exception as e:
+            logger.error("Ошибка при транскрипции голосового сообщения: %s", e)
+            await update.message.reply_text("Ошибка при транскрипции голосового сообщения: " + str(e), reply_markup=persistent_keyboard)
+
+    await enqueue_job(update, job)
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик ошибок: логирует исключение и отправляет traceback администратору."""
-    logger.error(msg="Exception while handling an update:", exc_info=context.error)
-    tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
-    tb_string = "".join(tb_list)
-    message = f"An exception occurred:\n{tb_string}"
-    try:
-        admin_ids = [int(x.strip()) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()]
-        for admin_id in admin_ids:
-            await context.bot.send_message(chat_id=admin_id, text=message)
-    except Exception as e:
-        logger.error(f"Не удалось отправить сообщение об ошибке администратору: {e}")
+    """Обработчик ошибок: учитывает исключение, админам уходят алерты и сводки (см. error_digest)."""
+    error_digest.report(context.error)
 
-def main():
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+async def on_startup(application: Application):
+    """
+    Открывает БД, восстанавливает задачи и состояние из снимка, возобновляет рассылки,
+    прерванные перезапуском, и запускает фоновое обслуживание БД и отправку сводок ошибок.
+    """
+    await asyncio.to_thread(db.init_db)
+    await lifecycle.restore(application)
+    await broadcast.resume_broadcasts(application.bot)
+    retention.start()
+    error_digest.start(application.bot, admin.ADMIN_IDS)
+
+async def on_shutdown(application: Application):
+    """Закрывает общий HTTP-клиент и сбрасывает очередь записи в БД при остановке бота."""
+    await api_client.close_client()
+    await asyncio.to_thread(db.close)
+
+def build_application(updater: bool = True, concurrent_updates=CONCURRENT_UPDATES) -> Application:
+    """
+    Собирает Application со всеми обработчиками.
+    updater=False – без собственного получения апдейтов (их подаёт процесс-распределитель в режиме шардов).
+    """
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(concurrent_updates)
+        .persistence(SQLitePersistence())
+        .post_init(on_startup)
+        .post_stop(lifecycle.drain)
+        .post_shutdown(on_shutdown)
+    )
+    if TELEGRAM_API_BASE:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE}/bot").base_file_url(f"{TELEGRAM_API_BASE}/file/bot")
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
     
     # Регистрируем админ-обработчики первыми
     admin.register_admin_handlers(application)
     
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("model", set_settings))
-    application.add_handler(CallbackQueryHandler(handle_settings_callback, pattern="^(model:|voice:)"))
+    application.add_handler(CommandHandler("cancel", cancel_jobs))
+    application.add_handler(CallbackQueryHandler(handle_settings_callback, pattern="^(model:|voice:|format:)"))
     application.add_handler(MessageHandler(filters.Regex(r"(?i)^сменить настройки$"), set_settings))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     application.add_handler(MessageHandler(filters.VOICE, handle_voice))
     
     application.add_error_handler(error_handler)
-    
+    return application
+
+def main():
+    if SHARD_WORKERS > 0:
+        # Один процесс принимает апдейты и раздаёт их воркерам по user_id
+        import sharding
+        sharding.run(SHARD_WORKERS)
+        return
+    if metrics.METRICS_PORT:
+        metrics.start_http_server(metrics.METRICS_PORT)
+    application = build_application()
     application.run_polling()
 
 if __name__ == '__main__':
@@ -0,0 +1,50 @@
+import asyncio
+import pytest
+import db
+import broadcast
+
+class FakeMessage:
+    message_id = 1
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(chat_id)
+        return FakeMessage()
+
+    async def edit_message_text(self, **kwargs):
+        pass
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    db.close()
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "activity.db"))
+    monkeypatch.setattr(db, "conn", None)
+    yield
+    db.close()
+
+def test_pause_all_keeps_broadcast_resumable(fresh_db, monkeypatch):
+    monkeypatch.setattr(broadcast, "BROADCAST_RATE", 50)
+    monkeypatch.setattr(broadcast, "_limiter", None)
+    db.init_db()
+    for user_id in range(100, 200):
+        db.add_or_update_user(user_id, None, f"user{user_id}", None)
+    bot = FakeBot()
+
+    async def main():
+        job_id = await broadcast.start_broadcast(bot, "hello", admin_chat_id=1)
+        await asyncio.sleep(0.5)
+        await broadcast.pause_all(timeout=5)
+        return job_id
+
+    job_id = asyncio.run(main())
+    db.flush()
+    counts = db.get_broadcast_counts(job_id)
+    recipients = [chat_id for chat_id in bot.sent if chat_id != 1]
+    # Каждая отправка отмечена в БД, рассылка не отменена и продолжится после перезапуска
+    assert counts.get("sent") == len(recipients)
+    assert counts.get("pending", 0) > 0
+    assert job_id in db.get_running_broadcast_jobs()
+    assert not broadcast._jobs
@@ -0,0 +1,55 @@
+import time
+import sqlite3
+import asyncio
+import pytest
+import db
+import metrics
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    db.close()
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "activity.db"))
+    monkeypatch.setattr(db, "conn", None)
+    yield db.DB_PATH
+    db.close()
+
+def _read_user_data(path, user_id):
+    with sqlite3.connect(path) as connection:
+        row = connection.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+def test_write_committed_within_flush_interval_under_steady_traffic(fresh_db, monkeypatch):
+    monkeypatch.setattr(db, "WRITE_FLUSH_INTERVAL", 0.3)
+    db.init_db()
+    db.save_user_data(1, "first")
+    started = time.monotonic()
+    committed_at = None
+    # Непрерывный поток записей не должен откладывать коммит до заполнения пачки
+    while time.monotonic() - started < 2:
+        db.save_user_data(2, str(time.monotonic()))
+        if committed_at is None and _read_user_data(fresh_db, 1) == "first":
+            committed_at = time.monotonic() - started
+        time.sleep(0.05)
+    assert committed_at is not None
+    assert committed_at < 0.3 + 0.5
+
+def test_batch_keeps_submission_order(fresh_db):
+    db.init_db()
+    db.save_user_data(1, "A")
+    db.delete_user_data(1)
+    db.save_user_data(1, "B")
+    assert db.flush(10)
+    assert db.get_user_data(1) == "B"
+
+def test_full_queue_drops_write_on_event_loop(fresh_db, monkeypatch):
+    import queue
+    monkeypatch.setattr(db, "_write_queue", queue.Queue(maxsize=1))
+    monkeypatch.setattr(db, "_ensure_writer", lambda: None)
+    before = metrics.get_counter(db.WRITES_DROPPED)
+
+    async def main():
+        db.save_user_data(1, "A")
+        db.save_user_data(1, "B")  # очередь полна и не разбирается – не должно блокировать
+
+    asyncio.run(asyncio.wait_for(main(), 5))
+    assert metrics.get_counter(db.WRITES_DROPPED) == before + 1
@@ -0,0 +1,59 @@
+import asyncio
+from collections import deque
+import pytest
+import error_digest
+
+class FakeBot:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text):
+        self.messages.append((chat_id, text))
+
+@pytest.fixture
+def digest(monkeypatch):
+    monkeypatch.setattr(error_digest, "_window", {})
+    monkeypatch.setattr(error_digest, "_previous", set())
+    monkeypatch.setattr(error_digest, "_sent", deque())
+    monkeypatch.setattr(error_digest, "_digest_backlog", {})
+    monkeypatch.setattr(error_digest, "_window_started", 0.0)
+    monkeypatch.setattr(error_digest, "ERROR_ALERTS_PER_MINUTE", 3)
+    monkeypatch.setattr(error_digest, "ERROR_DIGEST_INTERVAL", 300)
+    return error_digest
+
+def _raise(kind, i):
+    raise kind(i)
+
+def _report_burst(digest, kinds, times):
+    for i in range(times):
+        for kind in kinds:
+            try:
+                _raise(kind, i)
+            except Exception as e:
+                digest.report(e)
+
+def test_digest_over_budget_is_kept_and_sent_later(digest):
+    bot = FakeBot()
+    _report_burst(digest, (ConnectionError, KeyError, ValueError), 100)
+    # Новые ошибки съедают весь лимит, окно закрывается без отправки сводки
+    asyncio.run(digest.flush(bot, [1, 2], now=1.0))
+    asyncio.run(digest.flush(bot, [1, 2], now=301.0))
+    assert len(bot.messages) == 3
+    # Через минуту лимит восстановился – сводка с подсчётами доходит до обоих админов
+    digest._sent.clear()
+    asyncio.run(digest.flush(bot, [1, 2], now=302.0))
+    digests = {chat_id: text for chat_id, text in bot.messages[3:]}
+    assert set(digests) == {1, 2}
+    for text in digests.values():
+        assert "ValueError" in text and "occurred 100 times" in text
+    assert not digest._digest_backlog
+
+def test_alert_reaching_one_admin_is_retried_for_the_other(digest, monkeypatch):
+    monkeypatch.setattr(digest, "ERROR_ALERTS_PER_MINUTE", 1)
+    bot = FakeBot()
+    _report_burst(digest, (KeyError,), 1)
+    asyncio.run(digest.flush(bot, [1, 2], now=1.0))
+    digest._sent.clear()
+    asyncio.run(digest.flush(bot, [1, 2], now=2.0))
+    assert [chat_id for chat_id, _ in bot.messages] == [1, 2]
+    assert all(text.startswith("An exception occurred: KeyError") for _, text in bot.messages)
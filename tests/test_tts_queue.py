@@ -0,0 +1,45 @@
+import asyncio
+import tts_queue
+
+async def _noop():
+    pass
+
+def test_position_follows_round_robin_order():
+    async def main():
+        queue = tts_queue.FairQueue(workers=2, per_user_inflight=1, per_user_limit=10)
+        queue.pause()  # воркеры не забирают задачи, очередь остаётся как есть
+        a = [queue.submit(1, _noop) for _ in range(3)]
+        b = queue.submit(2, _noop)
+        c = queue.submit(3, _noop)
+        d = queue.submit(4, _noop)
+        # Круг: a0, b, c, d, a1, a2; два свободных воркера сразу берут a0 и b
+        positions = [queue.position(job) for job in (a[0], b, c, d, a[1], a[2])]
+        for task in queue._tasks:
+            task.cancel()
+        return positions
+
+    assert asyncio.run(main()) == [0, 0, 1, 2, 3, 4]
+
+def test_position_waits_for_own_running_job():
+    async def main():
+        queue = tts_queue.FairQueue(workers=4, per_user_inflight=1, per_user_limit=10)
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def long_job():
+            started.set()
+            await release.wait()
+
+        queue.submit(1, long_job)
+        await started.wait()
+        own = queue.submit(1, _noop)
+        other = queue.submit(2, _noop)
+        positions = queue.position(own), queue.position(other)
+        release.set()
+        await asyncio.wait_for(own.done.wait(), 5)
+        for task in queue._tasks:
+            task.cancel()
+        return positions
+
+    # Свободных воркеров хватает, но у пользователя 1 уже выполняется задача
+    assert asyncio.run(main()) == (1, 0)
@@ -0,0 +1,283 @@
+from dotenv import load_dotenv
+load_dotenv()  # Загружаем переменные окружения
+
+import io
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Каталог и максимальный размер дискового кэша озвучек
+CACHE_DIR = os.getenv("TTS_CACHE_DIR", "tts_cache")
+CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+# Telegram не принимает от бота файлы больше 50 МБ
+UPLOAD_LIMIT = 50 * 1024 * 1024
+
+def normalize_text(text: str) -> str:
+    """Нормализует текст для ключа кэша: схлопывает пробелы и переводы строк."""
+    return " ".join(text.split())
+
+def make_key(model: str, voice: str, instructions: str, text: str, fmt: str = "mp3") -> str:
+    """Строит content-addressed ключ по (model, voice, instructions, нормализованный текст, формат)."""
+    parts = [model, voice, instructions or "", normalize_text(text)]
+    if fmt != "mp3":
+        # Ключи MP3 остаются прежними, чтобы не терять уже накопленный кэш
+        parts.append(fmt)
+    raw = json.dumps(parts, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class TTSCache:
+    """
+    LRU-кэш готовых озвучек на диске, ограниченный по суммарному размеру.
+    Рядом с аудио хранится Telegram file_id, чтобы повторная отправка шла без загрузки файла.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> размер аудио в байтах, от старых к новым
+        self._total_bytes = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.file_id_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _audio_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".audio")
+
+    def _file_id_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".fid")
+
+    def _ensure_loaded(self):
+        """Лениво восстанавливает индекс LRU из содержимого каталога (по времени доступа)."""
+        if self._loaded:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for name in os.listdir(self.directory):
+            key, ext = os.path.splitext(name)
+            if ext == ".mp3":
+                # Старые записи (до поддержки Opus) хранились как <key>.mp3
+                os.replace(os.path.join(self.directory, name), self._audio_path(key))
+            elif ext != ".audio":
+                continue
+            st = os.stat(self._audio_path(key))
+            found.append((st.st_mtime, key, st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+        self._loaded = True
+
+    def get_file_id(self, key: str):
+        """Возвращает сохранённый Telegram file_id для ключа или None."""
+        with self._lock:
+            self._ensure_loaded()
+            if key not in self._entries:
+                return None
+            try:
+                with open(self._file_id_path(key), "r", encoding="utf-8") as f:
+                    file_id = f.read().strip()
+            except FileNotFoundError:
+                return None
+            if not file_id:
+                return None
+            self._entries.move_to_end(key)
+            self.file_id_hits += 1
+            return file_id
+
+    def get_path(self, key: str):
+        """Возвращает путь к закэшированному аудио или None (с учётом статистики hit/miss)."""
+        with self._lock:
+            self._ensure_loaded()
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            path = self._audio_path(key)
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                self._total_bytes -= self._entries.pop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return path
+
+    def put(self, key: str, src):
+        """
+        Сохраняет аудио из файлового объекта src в кэш и вытесняет старые записи.
+        Возвращает путь внутри кэша или None, если аудио слишком велико для кэша.
+        """
+        src.seek(0, os.SEEK_END)
+        size = src.tell()
+        if size > self.max_bytes:
+            return None
+        src.seek(0)
+        with self._lock:
+            self._ensure_loaded()
+        # Копирование идёт без блокировки: поиск в кэше на event loop не ждёт записи большого файла
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=key, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(src, f)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return self._commit(key, tmp_path, size)
+
+    def put_file(self, key: str, path: str, size: int):
+        """
+        Кладёт в кэш готовый файл из каталога кэша жёсткой ссылкой, без копирования
+        (если файловая система не позволяет – копирует). Сам path остаётся на месте.
+        """
+        if size > self.max_bytes:
+            return None
+        with self._lock:
+            self._ensure_loaded()
+        tmp_path = f"{path}.{key}.tmp"
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            with open(path, "rb") as src:
+                return self.put(key, src)
+        return self._commit(key, tmp_path, size)
+
+    def store(self, key: str, audio: "SynthesizedAudio"):
+        """Сохраняет результат синтеза в кэш (вызывается в фоне, параллельно с отправкой)."""
+        if audio.path is not None:
+            return self.put_file(key, audio.path, audio.size)
+        return self.put(key, io.BytesIO(audio.data))
+
+    def _commit(self, key: str, tmp_path: str, size: int):
+        with self._lock:
+            path = self._audio_path(key)
+            os.replace(tmp_path, path)
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)
+            self._entries[key] = size
+            self._total_bytes += size
+            self._evict()
+            return path
+
+    def set_file_id(self, key: str, file_id: str):
+        """Запоминает file_id, который Telegram вернул при отправке аудио."""
+        with self._lock:
+            if key not in self._entries:
+                return
+            with open(self._file_id_path(key), "w", encoding="utf-8") as f:
+                f.write(file_id)
+
+    def forget_file_id(self, key: str):
+        """Удаляет file_id, если Telegram перестал его принимать."""
+        with self._lock:
+            try:
+                os.remove(self._file_id_path(key))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            for path in (self._audio_path(key), self._file_id_path(key)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def stats_text(self) -> str:
+        """Текстовая сводка счётчиков кэша для админ-панели."""
+        with self._lock:
+            self._ensure_loaded()
+            lookups = self.hits + self.file_id_hits + self.misses
+            hit_rate = (self.hits + self.file_id_hits) / lookups * 100 if lookups else 0.0
+            return (
+                "TTS Cache:\n"
+                f"Entries: {len(self._entries)}\n"
+                f"Size: {self._total_bytes / 1024 / 1024:.1f} / {self.max_bytes / 1024 / 1024:.1f} MB\n"
+                f"file_id hits: {self.file_id_hits}\n"
+                f"Audio hits: {self.hits}\n"
+                f"Misses: {self.misses}\n"
+                f"Hit rate: {hit_rate:.1f}%\n"
+                f"Evictions: {self.evictions}"
+            )
+
+class AudioTooLarge(Exception):
+    """Аудио больше лимита загрузки Telegram: синтез прерывается, не дожидаясь конца."""
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class SynthesizedAudio:
+    """
+    Готовая озвучка, общая для всех, кто ждал один и тот же синтез:
+    байты в памяти или временный файл на диске, который удаляется вместе с объектом.
+    """
+
+    def __init__(self, data: bytes = None, path: str = None, size: int = 0):
+        self.data = data
+        self.path = path
+        self.size = size
+        self.stored = None  # задача записи в кэш, если она запущена
+        if path is not None:
+            weakref.finalize(self, _remove_quietly, path)
+
+    def open(self):
+        """Новый файловый объект для отправки (у каждого получателя своя позиция чтения)."""
+        if self.path is not None:
+            return open(self.path, "rb")
+        return io.BytesIO(self.data)
+
+class AudioSpool:
+    """
+    Буфер для ответа API: до max_size байт в памяти, дальше – временный файл в directory
+    (в каталоге кэша, откуда он попадает в кэш жёсткой ссылкой). Запись сверх limit – AudioTooLarge.
+    """
+
+    def __init__(self, directory: str, max_size: int, limit: int = UPLOAD_LIMIT):
+        self.directory = directory
+        self.max_size = max_size
+        self.limit = limit
+        self.size = 0
+        self.path = None
+        self._file = io.BytesIO()
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise AudioTooLarge(f"аудио больше {self.limit // 1024 // 1024} МБ – Telegram его не примет")
+        if self.path is None and self.size > self.max_size:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, self.path = tempfile.mkstemp(dir=self.directory, prefix="spool-", suffix=".tmp")
+            spilled = os.fdopen(fd, "wb")
+            spilled.write(self._file.getbuffer())
+            self._file = spilled
+        return self._file.write(data)
+
+    def finish(self) -> SynthesizedAudio:
+        """Закрывает буфер и возвращает его содержимое."""
+        if self.path is None:
+            return SynthesizedAudio(data=self._file.getvalue(), size=self.size)
+        self._file.close()
+        return SynthesizedAudio(path=self.path, size=self.size)
+
+    def discard(self):
+        """Удаляет данные после неудачного синтеза."""
+        self._file.close()
+        if self.path is not None:
+            _remove_quietly(self.path)
+
+cache = TTSCache(CACHE_DIR, CACHE_MAX_BYTES)
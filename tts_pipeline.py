@@ -0,0 +1,116 @@
+from dotenv import load_dotenv
+load_dotenv()  # Загружаем переменные окружения
+
+import os
+import re
+import random
+import asyncio
+import logging
+import resilience
+
+logger = logging.getLogger(__name__)
+
+# Ограничение API /audio/speech на длину input и параметры параллельного синтеза
+MAX_INPUT_CHARS = int(os.getenv("TTS_MAX_INPUT_CHARS", "4096"))
+CHUNK_CONCURRENCY = int(os.getenv("TTS_CHUNK_CONCURRENCY", "4"))
+# Повторы куска поверх повторов resilience.send: нужны для обрывов при чтении тела ответа
+CHUNK_RETRIES = int(os.getenv("TTS_CHUNK_RETRIES", "1"))
+
+_PARAGRAPH_RE = re.compile(r"\n\s*\n")
+_SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+")
+
+def _split_long(piece: str, limit: int, pattern) -> list:
+    """Разбивает piece по разделителю pattern, упаковывая части в куски не длиннее limit."""
+    chunks = []
+    current = ""
+    for part in pattern.split(piece) if pattern is not None else piece.split():
+        part = part.strip()
+        if not part:
+            continue
+        if len(part) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            if pattern is _PARAGRAPH_RE:
+                chunks.extend(_split_long(part, limit, _SENTENCE_RE))
+            elif pattern is _SENTENCE_RE:
+                chunks.extend(_split_long(part, limit, None))
+            else:
+                # Одно «слово» длиннее лимита – режем как есть
+                chunks.extend(part[i:i + limit] for i in range(0, len(part), limit))
+            continue
+        separator = "\n\n" if pattern is _PARAGRAPH_RE else " "
+        candidate = current + separator + part if current else part
+        if len(candidate) > limit:
+            chunks.append(current)
+            current = part
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+def split_text(text: str, limit: int = MAX_INPUT_CHARS) -> list:
+    """
+    Делит текст на куски не длиннее limit символов.
+    Старается резать по абзацам, затем по предложениям и только потом по словам.
+    """
+    text = text.strip()
+    if not text:
+        return []
+    if len(text) <= limit:
+        return [text]
+    return _split_long(text, limit, _PARAGRAPH_RE)
+
+def strip_id3(segment: bytes, keep_header: bool, keep_trailer: bool) -> bytes:
+    """
+    Убирает ID3-теги из MP3-сегмента, чтобы сегменты можно было склеить без перекодирования:
+    ID3v2 в начале (кроме первого сегмента) и ID3v1 в конце (кроме последнего).
+    """
+    if not keep_header and segment[:3] == b"ID3" and len(segment) >= 10:
+        size = (segment[6] << 21) | (segment[7] << 14) | (segment[8] << 7) | segment[9]
+        footer = 10 if segment[5] & 0x10 else 0
+        segment = segment[10 + size + footer:]
+    if not keep_trailer and len(segment) >= 128 and segment[-128:-125] == b"TAG":
+        segment = segment[:-128]
+    return segment
+
+async def _synthesize_chunk(index: int, chunk: str, synthesize, semaphore: asyncio.Semaphore) -> bytes:
+    """
+    Синтезирует один кусок, при временной ошибке повторяя только его (с экспоненциальной задержкой).
+    Ошибки запроса, которые повторять бессмысленно (4xx), сразу передаются вызывающему.
+    """
+    attempt = 0
+    while True:
+        async with semaphore:
+            try:
+                return await synthesize(chunk)
+            except resilience.UpstreamUnavailable:
+                raise
+            except Exception as e:
+                attempt += 1
+                if attempt > CHUNK_RETRIES or not resilience.is_retriable(e):
+                    raise
+                logger.warning("Ошибка синтеза куска %s (попытка %s): %s", index, attempt, e)
+        await asyncio.sleep(min(2 ** attempt, 30) * (0.5 + random.random() / 2))
+
+async def synthesize_long_text(text: str, synthesize, out, limit: int = MAX_INPUT_CHARS, concurrency: int = CHUNK_CONCURRENCY):
+    """
+    Озвучивает длинный текст: режет на куски, синтезирует их параллельно (не более concurrency
+    одновременно) и пишет MP3-сегменты в out строго по порядку.
+    synthesize – корутина synthesize(chunk_text) -> bytes.
+    """
+    chunks = split_text(text, limit)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    tasks = [
+        asyncio.create_task(_synthesize_chunk(i, chunk, synthesize, semaphore))
+        for i, chunk in enumerate(chunks)
+    ]
+    try:
+        last = len(tasks) - 1
+        for i, task in enumerate(tasks):
+            segment = await task
+            out.write(strip_id3(segment, keep_header=(i == 0), keep_trailer=(i == last)))
+    finally:
+        for task in tasks:
+            task.cancel()
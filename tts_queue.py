@@ -0,0 +1,239 @@
+from dotenv import load_dotenv
+load_dotenv()  # Загружаем переменные окружения
+
+import os
+import time
+import asyncio
+import logging
+import itertools
+from collections import deque
+import metrics
+import error_digest
+
+logger = logging.getLogger(__name__)
+
+# Общее число одновременных обращений к API, лимит одновременных задач и длина очереди на пользователя
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "8"))
+TTS_PER_USER_INFLIGHT = int(os.getenv("TTS_PER_USER_INFLIGHT", "1"))
+TTS_PER_USER_QUEUE = int(os.getenv("TTS_PER_USER_QUEUE", "20"))
+# Сколько последних ожиданий учитывать в статистике
+WAIT_SAMPLES = 1000
+
+QUEUE_DEPTH = "bot_tts_queue_depth"
+USERS_WAITING = "bot_tts_queue_users_waiting"
+
+class QueueFull(Exception):
+    """У пользователя уже слишком много задач в очереди."""
+
+class Job:
+    """
+    Задача очереди: корутинная функция func() пользователя user_id.
+    payload – необязательное JSON-описание задачи, по которому её можно восстановить после перезапуска.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, user_id: int, func, payload=None):
+        self.id = next(self._ids)
+        self.user_id = user_id
+        self.func = func
+        self.payload = payload
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.cancelled = False
+        self.done = asyncio.Event()
+
+class FairQueue:
+    """
+    Очередь задач к API с ограниченным пулом воркеров.
+    Пользователи обслуживаются по кругу (round-robin), у каждого не больше
+    per_user_inflight задач одновременно, поэтому один активный пользователь не вытесняет остальных.
+    """
+
+    def __init__(self, workers: int, per_user_inflight: int, per_user_limit: int):
+        self.workers = max(1, workers)
+        self.per_user_inflight = max(1, per_user_inflight)
+        self.per_user_limit = per_user_limit
+        self._queues = {}  # user_id -> deque[Job]
+        self._ready = deque()  # пользователи, чью следующую задачу можно запускать, по кругу
+        self._inflight = {}  # user_id -> число выполняющихся задач
+        self._wakeup = None
+        self._tasks = []
+        self._busy = 0
+        self._running = set()
+        self._depth = 0
+        self._paused = False
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def _start(self):
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def _update_depth(self, delta: int):
+        self._depth += delta
+        metrics.gauge_set(QUEUE_DEPTH, self._depth)
+        metrics.gauge_set(USERS_WAITING, len(self._queues))
+
+    def _can_run(self, user_id: int) -> bool:
+        return self._inflight.get(user_id, 0) < self.per_user_inflight
+
+    def submit(self, user_id: int, func, payload=None) -> Job:
+        """Ставит задачу в очередь пользователя. Бросает QueueFull, если очередь пользователя заполнена."""
+        self._start()
+        user_queue = self._queues.get(user_id)
+        if user_queue is not None and len(user_queue) >= self.per_user_limit:
+            raise QueueFull()
+        job = Job(user_id, func, payload)
+        if user_queue is None:
+            user_queue = self._queues[user_id] = deque()
+        user_queue.append(job)
+        if len(user_queue) == 1 and self._can_run(user_id):
+            self._ready.append(user_id)
+        self.submitted += 1
+        self._update_depth(1)
+        self._notify()
+        return job
+
+    def _notify(self):
+        self._wakeup.set()
+
+    def position(self, job: Job) -> int:
+        """
+        Место job среди ожидающих задач (1 – запустится первой из ждущих), 0 – запустится сразу.
+        Повторяет обход по кругу: сначала пользователи из _ready в их порядке, затем те, кто ждёт
+        завершения своей задачи; за круг каждый пользователь запускает по одной задаче.
+        """
+        user_queue = self._queues.get(job.user_id)
+        if job.started_at is not None or user_queue is None or job not in user_queue:
+            return 0
+        index = user_queue.index(job)
+        ready = set(self._ready)
+        rotation = list(self._ready) + [uid for uid in self._queues if uid not in ready]
+        turn = rotation.index(job.user_id)
+        # До job её пользователь запустит index своих задач, а каждый другой – по задаче за круг:
+        # index + 1 кругов, если он в круге раньше, и index, если позже
+        ahead = index
+        for i, uid in enumerate(rotation):
+            if uid != job.user_id:
+                ahead += min(len(self._queues[uid]), index + 1 if i < turn else index)
+        free = self.workers - self._busy
+        if ahead < free and self._can_run(job.user_id):
+            return 0
+        return max(1, ahead - free + 1)
+
+    def cancel_user(self, user_id: int) -> int:
+        """Отменяет все ещё не начатые задачи пользователя. Возвращает их число."""
+        user_queue = self._queues.pop(user_id, None)
+        if not user_queue:
+            return 0
+        try:
+            self._ready.remove(user_id)
+        except ValueError:
+            pass
+        for job in user_queue:
+            job.cancelled = True
+            job.done.set()
+        self.cancelled += len(user_queue)
+        self._update_depth(-len(user_queue))
+        return len(user_queue)
+
+    def pause(self):
+        """Перестаёт запускать новые задачи (выполняющиеся продолжают работу), например перед перезапуском."""
+        self._paused = True
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """Ждёт завершения выполняющихся задач не дольше timeout. Возвращает True, если все завершились."""
+        deadline = time.monotonic() + timeout
+        while self._running and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        return not self._running
+
+    def pending_payloads(self) -> list:
+        """
+        Описания незавершённых задач для восстановления: сначала выполняющиеся, затем ожидающие,
+        так что порядок задач каждого пользователя сохраняется.
+        """
+        running = sorted(self._running, key=lambda job: job.id)
+        queued = [job for user_queue in self._queues.values() for job in user_queue]
+        return [job.payload for job in running + queued if job.payload is not None]
+
+    async def _next_job(self) -> Job:
+        while self._paused or not self._ready:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        user_id = self._ready.popleft()
+        user_queue = self._queues[user_id]
+        job = user_queue.popleft()
+        self._inflight[user_id] = self._inflight.get(user_id, 0) + 1
+        if not user_queue:
+            del self._queues[user_id]
+        elif self._can_run(user_id):
+            # В конец круга, чтобы следующими шли другие пользователи
+            self._ready.append(user_id)
+        self._update_depth(-1)
+        return job
+
+    def _finish(self, user_id: int):
+        left = self._inflight.get(user_id, 0) - 1
+        if left > 0:
+            self._inflight[user_id] = left
+        else:
+            self._inflight.pop(user_id, None)
+        if user_id in self._queues and user_id not in self._ready and self._can_run(user_id):
+            self._ready.append(user_id)
+            self._notify()
+
+    async def _worker(self):
+        while True:
+            job = await self._next_job()
+            job.started_at = time.monotonic()
+            self._waits.append(job.started_at - job.enqueued_at)
+            metrics.observe(metrics.STAGE_SECONDS, job.started_at - job.enqueued_at, stage="queue_wait")
+            self._busy += 1
+            self._running.add(job)
+            try:
+                await job.func()
+                self.completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.error("Ошибка задачи %s пользователя %s: %s", job.id, job.user_id, e)
+                error_digest.report(e)
+            finally:
+                self._busy -= 1
+                self._running.discard(job)
+                self._finish(job.user_id)
+                job.done.set()
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    def stats_text(self) -> str:
+        """Текстовая сводка метрик очереди для админ-панели."""
+        waits = sorted(self._waits)
+        if waits:
+            avg = sum(waits) / len(waits)
+            p95 = waits[min(len(waits) - 1, int(len(waits) * 0.95))]
+            wait_line = f"Wait: avg {avg:.2f}s, p95 {p95:.2f}s, max {waits[-1]:.2f}s"
+        else:
+            wait_line = "Wait: no data"
+        return (
+            "TTS Queue:\n"
+            f"Depth: {self.depth} (users waiting: {len(self._queues)})\n"
+            f"Busy workers: {self._busy} / {self.workers}\n"
+            f"{wait_line}\n"
+            f"Submitted: {self.submitted}\n"
+            f"Completed: {self.completed}\n"
+            f"Failed: {self.failed}\n"
+            f"Cancelled: {self.cancelled}"
+        )
+
+queue = FairQueue(TTS_WORKERS, TTS_PER_USER_INFLIGHT, TTS_PER_USER_QUEUE)